@@ -0,0 +1,61 @@
+"""
+Same as test1.py, but both tanks start shooting at the same moment
+Requires python 3.5+ and yandex-tank-api[client]
+"""
+import asyncio
+import logging
+
+import aiohttp
+
+import phout_aggregator
+from yandex_tank_api.client import TankClient, coordinated_start, make_connector
+
+logging.basicConfig(level=logging.DEBUG)
+
+api_servers = ['http://tank01.haze.yandex.net:8888',
+               'http://tank02.haze.yandex.net:8888']
+configs = ['first.ini', 'second.ini']
+
+
+def slurp(filename):
+    with open(filename, 'r') as f:
+        return f.read()
+
+
+async def find_phout(tank, session_id):
+    for f in await tank.artifacts(session_id):
+        if f.startswith('phout_') and f.endswith('.log'):
+            return f
+    raise RuntimeError('No phout in session ' + session_id)
+
+
+async def shoot():
+    async with aiohttp.ClientSession(connector=make_connector()) as http:
+        tanks = [TankClient(url, http_session=http) for url in api_servers]
+
+        logging.info('Preparing tanks')
+        started = await coordinated_start(
+            tanks, [slurp(config) for config in configs])
+        for tank, shoot in zip(tanks, started):
+            logging.info(
+                '%s started %s s late', tank.base_url, shoot['skew'])
+
+        await asyncio.gather(*[
+            tank.wait_finished(shoot['session'])
+            for tank, shoot in zip(tanks, started)
+        ])
+        logging.info('All tanks finished')
+
+        phouts = []
+        for i, (tank, shoot) in enumerate(zip(tanks, started), 1):
+            phout = await find_phout(tank, shoot['session'])
+            local_phout = 'phout{}.txt'.format(i)
+            logging.info('Downloading %s from %s', phout, tank.base_url)
+            await tank.download_artifact(shoot['session'], phout, local_phout)
+            phouts.append(local_phout)
+
+    logging.info('Merging phouts')
+    phout_aggregator.merge_phouts(phouts, 'result_phout.txt')
+
+
+asyncio.get_event_loop().run_until_complete(shoot())
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+"""
+Benchmark of phout merging: generates phouts of several tanks,
+merges them with the old line-by-line min() merge and with
+yandex_tank_api.phout.merge_phouts, checks and compares the results.
+
+    python phout_merge_benchmark.py --tanks 16 --lines 1000000
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import yandex_tank_api.phout
+
+
+def generate_phout(filename, lines, start_ts, seed):
+    """Write phout ordered by receive time, like phantom does"""
+    rnd = random.Random(seed)
+    ts = start_ts
+    with open(filename, 'w', 1024 * 1024) as phout:
+        buf = []
+        for _ in range(lines):
+            ts += rnd.expovariate(10000.0)
+            interval = int(rnd.lognormvariate(8, 1)) + 1
+            send_ts = ts - interval * 1e-6
+            buf.append(
+                '%.3f\t#%d\t%d\t%d\t%d\t%d\t%d\t%d\t%d\t%d\t0\t200\n' % (
+                    send_ts, rnd.randint(0, 3), interval, 10, 20,
+                    interval - 60, 30, interval, 200, 1000))
+            if len(buf) >= 10000:
+                phout.writelines(buf)
+                buf = []
+        phout.writelines(buf)
+
+
+def old_merge(filenames, outfilename):
+    """The merge from the former phout_aggregator.py, with EOF fixed"""
+
+    def phout_reader(filename):
+        with open(filename, 'r', 300000) as f:
+            for line in f:
+                yield line, yandex_tank_api.phout.receive_ts(
+                    line.encode('ascii'))
+
+    readers = [phout_reader(filename) for filename in filenames]
+    current = [next(reader) for reader in readers]
+    left_files = list(range(len(readers)))
+    with open(outfilename, 'w', 1000000) as outfile:
+        while left_files:
+            i = min(left_files, key=lambda x: current[x][1])
+            outfile.write(current[i][0])
+            try:
+                current[i] = next(readers[i])
+            except StopIteration:
+                left_files.remove(i)
+
+
+def check_ordered(filename):
+    """
+    Return number of lines, fail if they are not ordered by receive time.
+    send_ts has millisecond precision, so does the order of the input.
+    """
+    count = 0
+    last = 0
+    for chunk in yandex_tank_api.phout.read_chunks(filename):
+        for line in chunk:
+            key = yandex_tank_api.phout.receive_ts(line)
+            assert key > last - 1e-3, 'Unordered line %d' % count
+            last = max(last, key)
+            count += 1
+    return count
+
+
+def timed(name, fn, filenames, outfilename, total_bytes):
+    started = time.time()
+    fn(filenames, outfilename)
+    elapsed = time.time() - started
+    print('%-8s %7.2f s %8.1f MB/s' % (
+        name, elapsed, total_bytes / elapsed / 1e6))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tanks', type=int, default=8)
+    parser.add_argument('--lines', type=int, default=500000,
+                        help='Lines per tank phout')
+    parser.add_argument('--skip-old', action='store_true',
+                        help='Do not run the old merge, it is slow')
+    parser.add_argument('--dir', default=None,
+                        help='Directory for generated files')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        filenames = [
+            os.path.join(work_dir, 'phout_%d.log' % i)
+            for i in range(args.tanks)
+        ]
+        for i, filename in enumerate(filenames):
+            generate_phout(filename, args.lines, 1500000000.0, i)
+        total_bytes = sum(os.path.getsize(f) for f in filenames)
+        print('%d phouts, %d lines, %.1f MB' % (
+            args.tanks, args.tanks * args.lines, total_bytes / 1e6))
+
+        new_out = os.path.join(work_dir, 'merged_new.log')
+        new = timed(
+            'heap', yandex_tank_api.phout.merge_phouts, filenames, new_out,
+            total_bytes)
+        assert check_ordered(new_out) == args.tanks * args.lines
+        if not args.skip_old:
+            old_out = os.path.join(work_dir, 'merged_old.log')
+            old = timed('old', old_merge, filenames, old_out, total_bytes)
+            assert os.path.getsize(old_out) == os.path.getsize(new_out)
+            print('speedup  %7.1fx' % (old / new))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
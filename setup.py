@@ -40,6 +40,9 @@ setup(
         'flake8',
     ],
     install_requires=requirements,
+    extras_require={
+        'client': ['aiohttp>=3.5'],
+    },
     tests_require=['pytest', ],
     packages=['yandex_tank_api'],
     package_dir={'yandex_tank_api': 'yandex_tank_api'},
@@ -50,5 +53,9 @@ setup(
             'static/js/vendor/*.js', 'config/*'
         ],
     },
-    scripts=['scripts/yandex-tank-api-server'],
+    scripts=[
+        'scripts/yandex-tank-api-server',
+        'scripts/yandex-tank-api-merge-phouts',
+        'scripts/yandex-tank-api-merge-histograms',
+    ],
     test_suite='yandex-tank-api', )
@@ -0,0 +1,79 @@
+import random
+
+import pytest
+
+import yandex_tank_api.latency as latency
+
+
+def test_bucket_round_trip():
+    bits = latency.SIGNIFICANT_BITS
+    previous_bound = -1
+    for index in range(20 * (1 << bits)):
+        bound = latency.bucket_upper_bound(index)
+        assert bound > previous_bound
+        # Bucket holds values from the end of the previous one to its bound
+        assert latency.bucket_index(previous_bound + 1) == index
+        assert latency.bucket_index(bound) == index
+        previous_bound = bound
+
+
+def test_bucket_relative_width():
+    bits = latency.SIGNIFICANT_BITS
+    for value in [0, 1, 127, 128, 129, 1000, 12345, 10 ** 6, 10 ** 9]:
+        bound = latency.bucket_upper_bound(latency.bucket_index(value))
+        assert value <= bound <= value * (1 + 2.0 ** (1 - bits))
+
+
+def test_record_values_matches_bucket_index():
+    values = [random.randrange(10 ** 7) for _ in range(1000)] + list(range(300))
+    histogram = latency.LatencyHistogram()
+    histogram.record_values(values)
+    assert histogram.count == len(values)
+    assert histogram.sum == sum(values)
+    assert histogram.max == max(values)
+    for value in values:
+        assert histogram.buckets[latency.bucket_index(value)] > 0
+    assert sum(histogram.buckets.values()) == len(values)
+
+
+def test_merge_equals_recording_all_values():
+    first = [random.randrange(10 ** 6) for _ in range(500)]
+    second = [random.randrange(10 ** 4) for _ in range(500)]
+    merged = latency.LatencyHistograms()
+    for ts, values in [(100, first), (101, second)]:
+        part = latency.LatencyHistograms()
+        part.second(ts).record_values(values)
+        part.second(102).record_values(values)
+        merged.merge(part)
+    expected = latency.LatencyHistogram()
+    expected.record_values(first + second)
+    assert merged.seconds[102].to_dict() == expected.to_dict()
+    assert merged.total(since=100, until=102).to_dict() == expected.to_dict()
+    assert merged.total().count == 2 * len(first + second)
+
+
+def test_merge_different_significant_bits():
+    with pytest.raises(ValueError):
+        latency.LatencyHistograms().merge(
+            latency.LatencyHistograms(significant_bits=5))
+
+
+def test_quantiles():
+    histogram = latency.LatencyHistogram()
+    histogram.record_values(list(range(1, 1001)))
+    stats = histogram.stats([50, 100])
+    assert stats['count'] == 1000
+    assert stats['max'] == 1000
+    assert 500 <= stats['quantiles']['50'] <= 500 * (1 + 1.0 / 64)
+    assert stats['quantiles']['100'] == 1000
+    assert latency.LatencyHistogram().quantile(50) is None
+
+
+def test_save_load(tmpdir):
+    histograms = latency.LatencyHistograms()
+    histograms.second(100).record_values([1, 1000, 10 ** 6])
+    filename = str(tmpdir.join(latency.ARTIFACT_NAME))
+    histograms.save(filename)
+    loaded = latency.LatencyHistograms.load(filename)
+    assert loaded.to_dict() == histograms.to_dict()
+    assert latency.merge_files([filename, filename]).total().count == 6
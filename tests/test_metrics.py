@@ -0,0 +1,76 @@
+import yandex_tank_api.metrics as metrics
+
+
+def family_lines(text, name):
+    comments = ('# TYPE {} '.format(name), '# HELP {} '.format(name))
+    return [
+        line for line in text.split('\n')
+        if line.startswith(comments) or line.startswith(name)
+    ]
+
+
+def test_render_counters():
+    registry = metrics.Metrics()
+    registry.observe_request('RunHandler', 'POST', 200, 0.003)
+    registry.observe_request('RunHandler', 'POST', 200, 0.2)
+    registry.observe_request('RunHandler', 'GET', 404, 0.001)
+    text = registry.render([])
+    assert text.endswith('\n')
+    assert family_lines(text, 'tank_api_requests_total') == [
+        '# TYPE tank_api_requests_total counter',
+        '# HELP tank_api_requests_total HTTP requests handled by the API server',
+        'tank_api_requests_total'
+        '{handler="RunHandler",method="GET",code="404"} 1',
+        'tank_api_requests_total'
+        '{handler="RunHandler",method="POST",code="200"} 2',
+    ]
+
+
+def test_render_histogram():
+    registry = metrics.Metrics()
+    registry.observe_status_message('running', lag=0.003)
+    registry.observe_status_message('running', lag=100.0)
+    registry.observe_status_message('running')
+    lines = family_lines(registry.render([]), 'tank_api_status_lag_seconds')
+    assert lines[0] == '# TYPE tank_api_status_lag_seconds histogram'
+    assert 'tank_api_status_lag_seconds_bucket{le="0.0025"} 0' in lines
+    assert 'tank_api_status_lag_seconds_bucket{le="0.005"} 1' in lines
+    assert 'tank_api_status_lag_seconds_bucket{le="5.0"} 1' in lines
+    assert lines[-3:] == [
+        'tank_api_status_lag_seconds_bucket{le="+Inf"} 2',
+        'tank_api_status_lag_seconds_count 2',
+        'tank_api_status_lag_seconds_sum 100.003',
+    ]
+
+
+def test_render_gauges():
+    gauges = [
+        ('tank_api_sessions', 'Sessions by status', [
+            ([('status', 'a "quoted"\\path\nline')], 3),
+            ([('status', 'skipped')], None),
+        ]),
+        ('tank_api_disk_free_bytes', 'Free disk space', [([], None)]),
+    ]
+    text = metrics.Metrics().render(gauges)
+    assert family_lines(text, 'tank_api_sessions') == [
+        '# TYPE tank_api_sessions gauge',
+        '# HELP tank_api_sessions Sessions by status',
+        'tank_api_sessions{status="a \\"quoted\\"\\\\path\\nline"} 3',
+    ]
+    assert 'tank_api_disk_free_bytes' not in text
+
+
+def test_render_openmetrics():
+    registry = metrics.Metrics()
+    registry.count_response_bytes('ArtifactHandler', 10)
+    text = registry.render(
+        [('tank_api_sessions', 'Sessions', [([], 1.5)])], openmetrics=True)
+    assert text.endswith('\n# EOF\n')
+    assert family_lines(text, 'tank_api_response_bytes') == [
+        '# TYPE tank_api_response_bytes counter',
+        '# HELP tank_api_response_bytes '
+        'Response body bytes written before compression',
+        'tank_api_response_bytes_total{handler="ArtifactHandler"} 10',
+    ]
+    assert 'tank_api_sessions 1.5' in text.split('\n')
+    assert metrics.format_value(float('inf')) == '+Inf'
@@ -0,0 +1,72 @@
+import yandex_tank_api.phout as phout
+
+
+def phout_line(send_ts, interval_real, tag='#0'):
+    return '{:.3f}\t{}\t{}\t10\t20\t{}\t30\t{}\t200\t1000\t0\t200'.format(
+        send_ts, tag, interval_real, interval_real - 60,
+        interval_real).encode('ascii')
+
+
+def write_phout(tmpdir, name, lines, tail=b'\n'):
+    path = tmpdir.join(name)
+    path.write(b'\n'.join(lines) + tail, mode='wb')
+    return str(path)
+
+
+def read_lines(path):
+    with open(path, 'rb') as source:
+        return source.read().split(b'\n')
+
+
+def test_merge_orders_by_receive_time(tmpdir):
+    first = [phout_line(100.0, 500000), phout_line(100.2, 900000)]
+    second = [phout_line(100.1, 100000), phout_line(101.0, 0)]
+    outfile = str(tmpdir.join('merged'))
+    written = phout.merge_phouts(
+        [write_phout(tmpdir, 'first', first),
+         write_phout(tmpdir, 'second', second)],
+        outfile,
+        chunk_bytes=64)
+    assert written == 4
+    assert read_lines(outfile) == [
+        second[0], first[0], second[1], first[1], b''
+    ]
+
+
+def test_merge_last_line_without_newline(tmpdir):
+    lines = [phout_line(100.0, 1000), phout_line(100.5, 1000)]
+    outfile = str(tmpdir.join('merged'))
+    written = phout.merge_phouts(
+        [write_phout(tmpdir, 'phout', lines, tail=b'')], outfile,
+        chunk_bytes=16)
+    assert written == 2
+    assert read_lines(outfile) == lines + [b'']
+
+
+def test_merge_empty_files(tmpdir):
+    outfile = str(tmpdir.join('merged'))
+    written = phout.merge_phouts(
+        [write_phout(tmpdir, 'empty', [], tail=b''),
+         write_phout(tmpdir, 'blank', [b'', b''])],
+        outfile)
+    assert written == 0
+    assert read_lines(outfile) == [b'']
+
+
+def test_merge_skips_malformed_lines(tmpdir):
+    lines = [
+        phout_line(100.0, 1000), b'garbage', b'100.5\t#0\tnot a number',
+        b'', phout_line(101.0, 1000)
+    ]
+    outfile = str(tmpdir.join('merged'))
+    written = phout.merge_phouts(
+        [write_phout(tmpdir, 'phout', lines)], outfile)
+    assert written == 2
+    assert read_lines(outfile) == [lines[0], lines[4], b'']
+
+
+def test_parse_timings_skips_malformed_lines():
+    receive_ts, intervals = phout.parse_timings(
+        [phout_line(100.0, 250000), b'garbage', b''])
+    assert receive_ts == [100.25]
+    assert intervals == [250000]
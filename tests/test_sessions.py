@@ -0,0 +1,50 @@
+import json
+
+import pytest
+
+import yandex_tank_api.sessions as sessions
+
+
+def test_round_trip_after_reopen(tmpdir, monkeypatch):
+    clock = iter(range(1000, 2000))
+    monkeypatch.setattr(sessions.time, 'time', lambda: next(clock))
+    registry = sessions.SessionRegistry(str(tmpdir))
+    registry.put('S1', {'status': 'success', 'current_stage': 'finished'})
+    registry.put('S2', {'status': 'running', 'current_stage': 'poll'})
+    registry.put('S3', {'status': 'failed', 'reason': 'boom'})
+
+    registry = sessions.SessionRegistry(str(tmpdir))
+    assert registry.get('S1') == {
+        'status': 'success', 'current_stage': 'finished'
+    }
+    found, total = registry.find()
+    assert total == 3
+    assert [session_id for session_id, _ in found] == ['S3', 'S2', 'S1']
+    found, total = registry.find(statuses=['success', 'failed'], limit=1)
+    assert total == 2
+    assert found == [('S3', {'status': 'failed', 'reason': 'boom'})]
+    with pytest.raises(KeyError):
+        registry.get('missing')
+
+
+def test_fail_unfinished(tmpdir):
+    registry = sessions.SessionRegistry(str(tmpdir))
+    registry.put('S1', {'status': 'running', 'current_stage': 'poll'})
+    registry.fail_unfinished('Server restarted')
+    assert sessions.SessionRegistry(str(tmpdir)).get('S1') == {
+        'status': 'failed', 'current_stage': 'poll',
+        'reason': 'Server restarted'
+    }
+
+
+def test_sessions_loaded_from_status_files(tmpdir):
+    for session_id, status in [('S1', 'success'), ('S2', 'running')]:
+        tmpdir.mkdir(session_id).join('status.json').write(
+            json.dumps({'status': status, 'session': session_id}))
+    tmpdir.mkdir('empty')
+    registry = sessions.SessionRegistry(str(tmpdir))
+    assert registry.get('S1') == {'status': 'success'}
+    registry.sync()
+    found, total = registry.find()
+    assert total == 2
+    assert dict(found)['S2']['status'] == 'failed'
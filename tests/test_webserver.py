@@ -0,0 +1,286 @@
+import io
+import json
+import multiprocessing
+import tarfile
+
+import pytest
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.testing
+
+import yandex_tank_api.sessions as sessions
+import yandex_tank_api.webserver as webserver
+
+
+class ServerFixture(object):
+    """ApiServer listening on a local port, with its own IOLoop"""
+
+    def __init__(self, work_dir, **options):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.io_loop.make_current()
+        self.in_queue = multiprocessing.Queue()
+        self.out_queue = multiprocessing.Queue()
+        self.srv = webserver.ApiServer(
+            self.in_queue, self.out_queue, work_dir, **options)
+        sock, self.port = tornado.testing.bind_unused_port()
+        self.http_server = tornado.httpserver.HTTPServer(self.srv.app)
+        self.http_server.add_sockets([sock])
+        self.client = tornado.httpclient.AsyncHTTPClient()
+
+    def fetch(self, path, **kwargs):
+        kwargs.setdefault('raise_error', False)
+        return self.io_loop.run_sync(lambda: self.client.fetch(
+            'http://127.0.0.1:{}{}'.format(self.port, path), **kwargs))
+
+    def close(self):
+        self.http_server.stop()
+        self.client.close()
+        self.io_loop.clear_current()
+        self.io_loop.close(all_fds=True)
+
+
+@pytest.fixture
+def server(request, tmpdir):
+    options = getattr(request, 'param', {})
+    fixture = ServerFixture(str(tmpdir), **options)
+    yield fixture
+    fixture.close()
+
+
+@pytest.mark.parametrize(
+    'server', [{'max_sessions': 1, 'session_queue_limit': 0}], indirect=True)
+def test_queue_limit_does_not_refuse_free_slot(server):
+    response = server.fetch('/run', method='POST', body='x: 1')
+    assert response.code == 200
+    assert server.out_queue.get(timeout=5)['cmd'] == 'run'
+
+    response = server.fetch('/run', method='POST', body='x: 1')
+    assert response.code == 503
+    assert json.loads(response.body)['reason'] == 'Session queue is full.'
+
+
+def make_session(work_dir, session_id, files):
+    session_dir = work_dir.mkdir(session_id)
+    session_dir.join('status.json').write(
+        json.dumps({'status': 'success', 'current_stage': 'finished'}))
+    for name, data in files.items():
+        session_dir.join(name).write(data, mode='wb')
+    return session_dir
+
+
+def test_archive_pads_removed_member(server, tmpdir):
+    session_dir = make_session(
+        tmpdir, 'S0', {'gone.log': b'0123456789', 'kept.log': b'data'})
+    assert server.fetch('/artifact/manifest?session=S0').code == 200
+    # Removed while the archive is sent: the cached manifest still has it
+    dir_mtime = session_dir.mtime()
+    session_dir.join('gone.log').remove()
+    session_dir.setmtime(dir_mtime)
+
+    response = server.fetch('/artifact/archive?session=S0&pattern=*.log')
+    assert response.code == 200
+    archive = tarfile.open(fileobj=io.BytesIO(response.body))
+    assert archive.extractfile('gone.log').read() == b'\0' * 10
+    assert archive.extractfile('kept.log').read() == b'data'
+
+
+def test_manifest_skips_temporary_files(server, tmpdir):
+    make_session(tmpdir, 'S0', {
+        'a.log': b'a', 'a.log.0123.tmp': b'upload', 'status.json.tmp': b'{}'
+    })
+    response = server.fetch('/artifact/manifest?session=S0')
+    assert [entry['name'] for entry in json.loads(response.body)['files']] \
+        == ['a.log', 'status.json']
+
+
+@pytest.mark.parametrize('server', [{'max_sessions': 1}], indirect=True)
+def test_queued_break_is_stored(server, tmpdir):
+    server.fetch('/run', method='POST', body='x: 1')
+    response = server.fetch('/run', method='POST', body='x: 1')
+    session_id = json.loads(response.body)['session']
+    assert json.loads(response.body)['status'] == 'queued'
+
+    response = server.fetch('/run?session={}&break=start'.format(session_id))
+    assert response.code == 200
+    # Wait for the registry writer
+    server.srv._registry_pool.submit(lambda: None).result()
+    registry = sessions.SessionRegistry(str(tmpdir))
+    assert registry.get(session_id)['break'] == 'start'
+
+
+def test_old_session_status_is_loaded(server, tmpdir):
+    make_session(tmpdir, 'S0', {})
+    response = server.fetch('/status?session=S0')
+    assert response.code == 200
+    assert json.loads(response.body)['status'] == 'success'
+    response = server.fetch('/status/stream?session=S0&timeout=0')
+    assert json.loads(response.body)['version'] == 0
+    assert server.fetch('/status?session=nope').code == 404
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-9', [(0, 10)]),
+    ('bytes=90-', [(90, 100)]),
+    ('bytes=95-200', [(95, 100)]),
+    ('bytes=-10', [(90, 100)]),
+    ('bytes=-200', [(0, 100)]),
+    ('bytes=0-0, -1', [(0, 1), (99, 100)]),
+    ('bytes=0-49,25-74', [(0, 50), (25, 75)]),
+    ('bytes=100-', []),
+    ('bytes=-0', []),
+    ('bytes=100-150, 200-', []),
+    ('bytes=100-150,0-0', [(0, 1)]),
+    ('bytes=5-1', None),
+    ('bytes=a-b', None),
+    ('bytes=1', None),
+    ('bytes=-', None),
+    ('items=0-1', None),
+    ('bytes=' + ','.join(
+        '{}-{}'.format(i, i) for i in range(webserver.MAX_BYTE_RANGES + 1)),
+     None),
+])
+def test_parse_byte_ranges(header, expected):
+    assert webserver.parse_byte_ranges(header, 100) == expected
+
+
+ARTIFACT = bytes(bytearray(range(256))) * 4
+
+
+def fetch_artifact(server, headers, **kwargs):
+    return server.fetch(
+        '/artifact?session=S0&filename=data.bin', headers=headers, **kwargs)
+
+
+def test_artifact_single_range(server, tmpdir):
+    make_session(tmpdir, 'S0', {'data.bin': ARTIFACT})
+    response = fetch_artifact(server, {'Range': 'bytes=10-19'})
+    assert response.code == 206
+    assert response.headers['Content-Range'] == 'bytes 10-19/1024'
+    assert response.body == ARTIFACT[10:20]
+
+
+def test_artifact_unsatisfiable_range(server, tmpdir):
+    make_session(tmpdir, 'S0', {'data.bin': ARTIFACT})
+    response = fetch_artifact(server, {'Range': 'bytes=2000-'})
+    assert response.code == 416
+    assert response.headers['Content-Range'] == 'bytes */1024'
+
+
+def test_artifact_ignored_range(server, tmpdir):
+    make_session(tmpdir, 'S0', {'data.bin': ARTIFACT})
+    response = fetch_artifact(server, {'Range': 'bytes=5-1'})
+    assert response.code == 200
+    assert response.body == ARTIFACT
+
+
+def test_artifact_multipart_ranges(server, tmpdir):
+    make_session(tmpdir, 'S0', {'data.bin': ARTIFACT})
+    response = fetch_artifact(server, {'Range': 'bytes=0-3,-4'})
+    assert response.code == 206
+    content_type, _, boundary = \
+        response.headers['Content-Type'].partition('; boundary=')
+    assert content_type == 'multipart/byteranges'
+    assert int(response.headers['Content-Length']) == len(response.body)
+    parts = response.body.split(b'--' + boundary.encode('ascii'))
+    assert parts[0] == b'' and parts[-1] == b'--\r\n'
+    bodies = []
+    for part in parts[1:-1]:
+        headers, _, body = part.partition(b'\r\n\r\n')
+        assert body.endswith(b'\r\n')
+        bodies.append((headers.split(b'\r\n')[2], body[:-2]))
+    assert bodies == [
+        (b'Content-Range: bytes 0-3/1024', ARTIFACT[:4]),
+        (b'Content-Range: bytes 1020-1023/1024', ARTIFACT[-4:]),
+    ]
+
+
+def test_artifact_if_range(server, tmpdir):
+    make_session(tmpdir, 'S0', {'data.bin': ARTIFACT})
+    etag = fetch_artifact(
+        server, {}, decompress_response=False).headers['Etag']
+    response = fetch_artifact(
+        server, {'Range': 'bytes=0-9', 'If-Range': etag})
+    assert response.code == 206
+    assert response.body == ARTIFACT[:10]
+
+    # Offsets of the compressed representation are not those of the file
+    gzip_etag = fetch_artifact(
+        server, {'Accept-Encoding': 'gzip'}).headers['Etag']
+    assert gzip_etag != etag
+    response = fetch_artifact(
+        server, {'Range': 'bytes=0-9', 'If-Range': gzip_etag})
+    assert response.code == 200
+    assert response.body == ARTIFACT
+
+    response = fetch_artifact(
+        server, {'Range': 'bytes=0-9', 'If-Range': '"other-version"'})
+    assert response.code == 200
+    assert response.body == ARTIFACT
+
+
+def live_point(ts, rps, bins, data, mean=None, max_time=None):
+    return {
+        'ts': ts, 'rps': rps, 'planned_rps': None, 'instances': 10,
+        'mean': mean, 'max': max_time, 'quantiles': {'50': 0, '99': 0},
+        'hist': {'bins': bins, 'data': data},
+        'proto_code': {'200': rps}, 'net_code': {'0': rps},
+    }
+
+
+def test_downsample_live_metrics():
+    points = [
+        live_point(100, 2, [1000, 2000], [1, 1], mean=1500, max_time=2000),
+        live_point(101, 4, [2000, 5000], [3, 1], mean=3000, max_time=5000),
+        live_point(103, 0, [], []),
+        live_point(104, 1, [9000], [1], mean=9000, max_time=9000),
+    ]
+    merged = webserver.downsample_live_metrics(points, 3, with_hist=True)
+    assert [point['ts'] for point in merged] == [99, 102]
+    first = merged[0]
+    assert first['seconds'] == 2
+    assert first['rps'] == 3.0
+    assert first['mean'] == 2500.0
+    assert first['max'] == 5000
+    assert first['instances'] == 10
+    assert first['planned_rps'] is None
+    assert first['hist'] == {'bins': [1000, 2000, 5000], 'data': [1, 4, 1]}
+    assert first['quantiles'] == {'50': 2000, '99': 5000}
+    assert first['proto_code'] == {'200': 6}
+    second = merged[1]
+    assert second['seconds'] == 2
+    assert second['rps'] == 0.5
+    assert second['mean'] == 9000.0
+    assert second['quantiles'] == {'50': 9000, '99': 9000}
+
+
+def test_downsample_live_metrics_keeps_seconds():
+    points = [live_point(100, 1, [1000], [1], mean=1000, max_time=1000)]
+    merged = webserver.downsample_live_metrics(points, 1)
+    expected = dict(points[0])
+    del expected['hist']
+    assert merged == [expected]
+    assert webserver.downsample_live_metrics(points, 1, with_hist=True) \
+        == points
+    assert webserver.downsample_live_metrics([live_point(
+        100, 0, [], [])], 5)[0]['mean'] is None
+
+
+def test_event_stream_is_not_compressed(server, tmpdir):
+    make_session(tmpdir, 'S0', dict(
+        ('file{}.log'.format(i), b'data') for i in range(50)))
+    gzip_only = {'Accept-Encoding': 'gzip'}
+    response = server.fetch(
+        '/artifact/manifest?session=S0', headers=gzip_only,
+        decompress_response=False)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers.get_list('Vary') == ['Accept-Encoding']
+
+    response = server.fetch(
+        '/status/stream?session=S0',
+        headers=dict(gzip_only, Accept='text/event-stream'),
+        decompress_response=False)
+    assert response.code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['Content-Type'] == 'text/event-stream'
+    assert response.body.startswith(b'id: 0\ndata: {')
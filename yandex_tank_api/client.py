@@ -0,0 +1,485 @@
+"""
+Asyncio client for yandex-tank-api.
+Requires python 3.5+ and aiohttp: pip install yandex-tank-api[client]
+
+Typical usage:
+
+    async with TankClient('http://tank1:8888') as tank:
+        session_id = await tank.run(config, breakpoint='start')
+        await tank.wait_for_break(session_id)
+        await tank.set_break(session_id, 'finished')
+        status = await tank.wait_finished(session_id)
+        await tank.download_archive(session_id, 'artifacts.tar.gz',
+                                    compression='gzip')
+
+Clients of several tanks may share one aiohttp.ClientSession:
+
+    async with aiohttp.ClientSession(connector=make_connector()) as http:
+        tanks = [TankClient(url, http_session=http) for url in urls]
+        sessions = await asyncio.gather(*[t.run(config) for t in tanks])
+
+Several tanks can start shooting at the same moment:
+
+    started = await coordinated_start(tanks, configs)
+"""
+
+import asyncio
+import os
+import time
+
+import aiohttp
+
+import yandex_tank_api.common as common
+import yandex_tank_api.latency as latency
+
+FINAL_STATUSES = ['success', 'failed']
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# ETag of a resumable download is kept next to the target
+ETAG_SUFFIX = '.etag'
+STATUS_WAIT_TIMEOUT = 30
+CONNECTIONS_PER_TANK = 4
+# Time for the start command to reach all tanks
+START_DELAY = 2.0
+
+
+class CoordinationError(Exception):
+    """Some of the tanks failed before the coordinated start"""
+
+
+class TankApiError(Exception):
+    """API server replied with an error code"""
+
+    def __init__(self, code, reason, reply=None):
+        super(TankApiError, self).__init__(
+            '{}: {}'.format(code, reason))
+        self.code = code
+        self.reason = reason
+        self.reply = reply or {}
+
+
+def make_connector(connections_per_tank=CONNECTIONS_PER_TANK):
+    """Return keep-alive connection pool for TankClient sessions"""
+    return aiohttp.TCPConnector(limit=0, limit_per_host=connections_per_tank)
+
+
+def stage_index(stage):
+    """Return position of the stage in the test sequence, -1 if not started"""
+    try:
+        return common.TEST_STAGE_ORDER.index(stage)
+    except ValueError:
+        return -1
+
+
+def is_finished(status):
+    """Return true if the session has finished"""
+    return status.get('status') in FINAL_STATUSES
+
+
+def has_completed_stage(status, stage):
+    """Return true if the session has completed the stage or finished"""
+    if is_finished(status):
+        return True
+    current = stage_index(status.get('current_stage'))
+    return current > stage_index(stage) or (
+        current == stage_index(stage) and status.get('stage_completed', False))
+
+
+def is_at_break(status):
+    """Return true if the session waits at its break or has finished"""
+    if is_finished(status):
+        return True
+    if not status.get('stage_completed', False) \
+            or status.get('break') is None:
+        return False
+    return stage_index(status.get('current_stage')) + 1 \
+        >= stage_index(status['break'])
+
+
+class TankClient(object):
+    """
+    Client of one tank API server.
+    Requests to the server share keep-alive connections.
+    """
+
+    def __init__(self, base_url, http_session=None, timeout=None):
+        """
+        base_url
+            e.g. http://tank:8888
+
+        http_session
+            aiohttp.ClientSession to share connections with other clients,
+            the client creates and closes its own one if not specified
+
+        timeout
+            aiohttp.ClientTimeout for requests other than waits and downloads
+        """
+        self.base_url = base_url.rstrip('/')
+        self._own_session = http_session is None
+        self._http = http_session
+        self.timeout = timeout or aiohttp.ClientTimeout(total=60)
+
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = aiohttp.ClientSession(connector=make_connector())
+        return self._http
+
+    async def close(self):
+        """Close own connections"""
+        if self._own_session and self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @staticmethod
+    def _params(**params):
+        return dict(
+            (name, str(value)) for name, value in params.items()
+            if value is not None)
+
+    @staticmethod
+    async def _check(response):
+        """Raise TankApiError if the response has an error code"""
+        if response.status < 400:
+            return
+        try:
+            reply = await response.json(content_type=None)
+            reason = reply.get('reason', response.reason)
+        except ValueError:
+            reply, reason = None, response.reason
+        raise TankApiError(response.status, reason, reply)
+
+    async def _request(
+            self, method, path, data=None, client_timeout=None, **params):
+        """Make request and return decoded json reply"""
+        async with self.http.request(
+                method, self.base_url + path, params=self._params(**params),
+                data=data, timeout=client_timeout or self.timeout) as response:
+            await self._check(response)
+            return await response.json(content_type=None)
+
+    async def validate(self, config):
+        """Validate config, return {'config': ..., 'errors': [...]}"""
+        return await self._request('POST', '/validate', data=config)
+
+    async def run(
+            self, config, test=None, breakpoint=None, priority=None,
+            heartbeat=None):
+        """Start or queue new session, return session ID"""
+        reply = await self._request(
+            'POST', '/run', data=config, test=test, priority=priority,
+            heartbeat=heartbeat, **{'break': breakpoint})
+        return reply['session']
+
+    async def set_break(
+            self, session_id, breakpoint, heartbeat=None, start_at=None):
+        """
+        Set the next break of the session.
+        With start_at (unix time), the session leaves its current break
+        at that moment.
+        """
+        return await self._request(
+            'GET', '/run', session=session_id, heartbeat=heartbeat,
+            start_at=start_at, **{'break': breakpoint})
+
+    async def stop(self, session_id):
+        """Stop the session or remove it from the queue"""
+        return await self._request('GET', '/stop', session=session_id)
+
+    async def status(self, session_id):
+        """Return session status"""
+        return await self._request('GET', '/status', session=session_id)
+
+    async def sessions(self, **filters):
+        """Return dict of session statuses, see GET /status for filters"""
+        return await self._request('GET', '/status', **filters)
+
+    async def wait_status(
+            self, session_id, since=-1, timeout=STATUS_WAIT_TIMEOUT):
+        """
+        Wait until session status version exceeds since or timeout expires,
+        return status with its version
+        """
+        return await self._request(
+            'GET', '/status/stream',
+            client_timeout=aiohttp.ClientTimeout(
+                total=None, sock_read=timeout + 30),
+            session=session_id, since=since, timeout=timeout)
+
+    async def wait_for(self, session_id, predicate, timeout=None):
+        """
+        Wait until predicate(status) is true, return the status.
+        Raises asyncio.TimeoutError if timeout expires.
+        """
+
+        async def wait():
+            version = -1
+            while True:
+                status = await self.wait_status(session_id, since=version)
+                if predicate(status):
+                    return status
+                version = status['version']
+
+        return await asyncio.wait_for(wait(), timeout)
+
+    async def wait_for_stage(self, session_id, stage, timeout=None):
+        """Wait until the session completes the stage or finishes"""
+        return await self.wait_for(
+            session_id, lambda status: has_completed_stage(status, stage),
+            timeout)
+
+    async def wait_for_break(self, session_id, timeout=None):
+        """Wait until the session stops at its break or finishes"""
+        return await self.wait_for(session_id, is_at_break, timeout)
+
+    async def wait_finished(self, session_id, timeout=None):
+        """Wait until the session finishes"""
+        return await self.wait_for(session_id, is_finished, timeout)
+
+    async def artifacts(self, session_id):
+        """Return list of artifact file names"""
+        return await self._request('GET', '/artifact', session=session_id)
+
+    async def manifest(self, session_id, **params):
+        """Return artifact manifest, see GET /artifact/manifest for params"""
+        return await self._request(
+            'GET', '/artifact/manifest', session=session_id, **params)
+
+    async def live_metrics(self, session_id, since=None, resolution=None):
+        """Return per-second load metrics of the session"""
+        return await self._request(
+            'GET', '/live_metrics', session=session_id, since=since,
+            resolution=resolution)
+
+    async def latency(self, session_ids, resolution=None, quantiles=None):
+        """Return response time quantiles of the sessions, see GET /latency"""
+        if isinstance(session_ids, str):
+            session_ids = [session_ids]
+        params = self._params(resolution=resolution, quantiles=','.join(
+            str(q) for q in quantiles) if quantiles else None)
+        params = list(params.items()) + [
+            ('session', session_id) for session_id in session_ids]
+        async with self.http.get(
+                self.base_url + '/latency', params=params,
+                timeout=self.timeout) as response:
+            await self._check(response)
+            return await response.json(content_type=None)
+
+    async def latency_histograms(self, session_id):
+        """Return latency.LatencyHistograms of the finished session"""
+        async with self.http.get(
+                self.base_url + '/artifact', params=self._params(
+                    session=session_id, filename=latency.ARTIFACT_NAME),
+                timeout=self.timeout) as response:
+            await self._check(response)
+            return latency.LatencyHistograms.loads(await response.read())
+
+    async def _download(
+            self, path, target, headers=None, mode='wb', etag_path=None,
+            **params):
+        """
+        Stream response body to the target file, return its response.
+        ETag of a full response is saved to etag_path, if it is given.
+        """
+        async with self.http.get(
+                self.base_url + path, params=self._params(**params),
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=None, sock_read=300)
+        ) as response:
+            if response.status == 416:
+                return response
+            await self._check(response)
+            if response.status == 200:
+                mode = 'wb'
+                if etag_path is not None:
+                    save_etag(etag_path, response.headers.get('ETag'))
+            loop = asyncio.get_event_loop()
+            with open(target, mode) as target_file:
+                async for chunk in response.content.iter_chunked(
+                        DOWNLOAD_CHUNK_SIZE):
+                    # Writes may block on slow disks
+                    await loop.run_in_executor(None, target_file.write, chunk)
+            return response
+
+    async def download_artifact(
+            self, session_id, filename, target, resume=False):
+        """
+        Download artifact file to target path.
+        With resume, only the missing tail of an existing target is fetched
+        if the remote file has the ETag saved by the previous download,
+        otherwise the whole file is downloaded again.
+        Resumable downloads are not compressed in transfer.
+        """
+        if not resume:
+            await self._download(
+                '/artifact', target, session=session_id, filename=filename)
+            return
+        etag_path = target + ETAG_SUFFIX
+        headers = {'Accept-Encoding': 'identity'}
+        etag = load_etag(etag_path)
+        mode = 'wb'
+        local_size = os.path.getsize(target) \
+            if os.path.exists(target) else None
+        if etag is not None and local_size is not None:
+            headers['Range'] = 'bytes={}-'.format(local_size)
+            headers['If-Range'] = etag
+            mode = 'ab'
+        response = await self._download(
+            '/artifact', target, headers=headers, mode=mode,
+            etag_path=etag_path, session=session_id, filename=filename)
+        if response.status == 416 \
+                and content_range_size(response) != local_size:
+            # Target is longer than the remote file: it is not a prefix
+            del headers['Range'], headers['If-Range']
+            await self._download(
+                '/artifact', target, headers=headers, etag_path=etag_path,
+                session=session_id, filename=filename)
+
+    async def download_archive(
+            self, session_id, target, pattern=None, compression=None):
+        """Download tar archive of the session artifacts to target path"""
+        await self._download(
+            '/artifact/archive', target, session=session_id, pattern=pattern,
+            compression=compression)
+
+    async def upload(self, session_id, filename, source):
+        """Upload local file into the session directory"""
+        with open(source, 'rb') as source_file:
+            return await self._request(
+                'POST', '/upload', data=source_file,
+                client_timeout=aiohttp.ClientTimeout(
+                    total=None, sock_read=300),
+                session=session_id, filename=filename)
+
+
+def load_etag(path):
+    """Return ETag saved by save_etag or None"""
+    try:
+        with open(path) as etag_file:
+            return etag_file.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def save_etag(path, etag):
+    """Save ETag of a download, remove the saved one if etag is None"""
+    if etag is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, 'w') as etag_file:
+        etag_file.write(etag)
+
+
+def content_range_size(response):
+    """Return complete length from Content-Range of the response or None"""
+    _, _, size = response.headers.get('Content-Range', '').rpartition('/')
+    try:
+        return int(size)
+    except ValueError:
+        return None
+
+
+async def merged_latency_histograms(tanks, session_ids):
+    """
+    Return latency.LatencyHistograms merged from the sessions of several
+    tanks, e.g. merged.summary() has the quantiles of the whole test
+    """
+    histograms = await asyncio.gather(
+        *[tank.latency_histograms(session_id)
+          for tank, session_id in zip(tanks, session_ids)])
+    merged = latency.LatencyHistograms()
+    for tank_histograms in histograms:
+        merged.merge(tank_histograms)
+    return merged
+
+
+def has_scheduled_start_passed(status):
+    """Return true if the session has left the break at scheduled time"""
+    return 'skew' in status.get('scheduled_start', {}) or is_finished(status)
+
+
+async def _stop_all(tanks, session_ids):
+    """Stop sessions ignoring errors"""
+    await asyncio.gather(
+        *[tank.stop(session_id) for tank, session_id in zip(tanks, session_ids)
+          if session_id is not None],
+        return_exceptions=True)
+
+
+async def coordinated_start(
+        tanks, configs, start_delay=START_DELAY, prepare_timeout=None,
+        breakpoint='finished', test=None):
+    """
+    Prepare sessions on all tanks, then start them at the same moment.
+    Clocks of the tank hosts should be synchronized (e.g. with NTP).
+
+    tanks, configs
+        TankClient objects and the configs of their sessions
+
+    start_delay
+        The start is scheduled this many seconds after all tanks are prepared
+
+    prepare_timeout
+        Seconds to wait for the tanks to prepare, None to wait forever
+
+    breakpoint
+        Break after the start, 'finished' runs the tests to the end
+
+    Returns list of {'session': ..., 'start_at': ..., 'skew': ...},
+    skew is how late the tank actually started, in seconds.
+    If any tank fails before the start, stops the others
+    and raises CoordinationError.
+    """
+    created = await asyncio.gather(
+        *[tank.run(config, test=test, breakpoint='start')
+          for tank, config in zip(tanks, configs)],
+        return_exceptions=True)
+    session_ids = [
+        None if isinstance(result, Exception) else result
+        for result in created
+    ]
+    try:
+        errors = [
+            '{}: {}'.format(tank.base_url, result)
+            for tank, result in zip(tanks, created)
+            if isinstance(result, Exception)
+        ]
+        if errors:
+            raise CoordinationError(
+                'Failed to create sessions:\n' + '\n'.join(errors))
+
+        statuses = await asyncio.gather(
+            *[tank.wait_for_break(session_id, prepare_timeout)
+              for tank, session_id in zip(tanks, session_ids)])
+        errors = [
+            '{} {}: {}'.format(
+                tank.base_url, session_id, status.get('failures'))
+            for tank, session_id, status in zip(tanks, session_ids, statuses)
+            if status.get('status') != 'prepared' or status.get('failures')
+        ]
+        if errors:
+            raise CoordinationError(
+                'Failed to prepare:\n' + '\n'.join(errors))
+
+        start_at = time.time() + start_delay
+        await asyncio.gather(
+            *[tank.set_break(session_id, breakpoint, start_at=start_at)
+              for tank, session_id in zip(tanks, session_ids)])
+    except BaseException:
+        await _stop_all(tanks, session_ids)
+        raise
+
+    statuses = await asyncio.gather(
+        *[tank.wait_for(session_id, has_scheduled_start_passed)
+          for tank, session_id in zip(tanks, session_ids)])
+    return [{
+        'session': session_id,
+        'start_at': start_at,
+        'skew': status.get('scheduled_start', {}).get('skew'),
+    } for session_id, status in zip(session_ids, statuses)]
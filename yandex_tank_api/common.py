@@ -7,6 +7,7 @@ Commands from HTTP Server (from manager_queue):
         'break': --- see break requests for tank
         'test': --- only when creating new session
         'config': --- only when creating new  session
+        'start_at': --- optional, unix time to leave the current break at
         }
     Stop the test
         {
@@ -29,7 +30,8 @@ Status reported by tank (from manager_queue):
 =====
 
 Break requests (into tank_queue):
-    {'break': --- any stage from test_stage_order }
+    {'break': --- any stage from test_stage_order
+     'start_at': --- optional, unix time to leave the current break at }
 
 ====
 Status reported to HTTP Server (into webserver_queue):
@@ -49,7 +51,9 @@ Status reported to HTTP Server (into webserver_queue):
     }
 """
 
+import collections
 import functools
+import time
 
 TEST_STAGE_ORDER_AND_DEPS = [('init', set()), ('lock', 'init'),
                              ('configure', 'lock'), ('prepare', 'configure'),
@@ -84,3 +88,50 @@ def memoized(fn):
         return getattr(self, name)
 
     return property(fn_memoized)
+
+
+# Clock for measuring durations, time.monotonic is missing in python 2
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+def has_released_lock(status):
+    """Return true if the session has passed the unlock stage"""
+    stage = status.get('current_stage')
+    return stage == 'finished' \
+        or stage == 'unlock' and status.get('stage_completed', False)
+
+
+def parse_cpu_list(spec):
+    """Parse CPU list like '0-3,8' into list of CPU numbers"""
+    cpus = []
+    for part in spec.split(','):
+        first, _, last = part.strip().partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+class LRUCache(object):
+    """Keeps at most maxsize most recently used items"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        """Return cached value and mark it as recently used"""
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            return default
+        self._items[key] = value
+        return value
+
+    def put(self, key, value):
+        """Store value, evicting the least recently used items"""
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
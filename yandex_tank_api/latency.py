@@ -0,0 +1,285 @@
+"""
+Mergeable per-second response time histograms
+
+Buckets are log-linear, as in HdrHistogram: values below
+2 ** significant_bits have their own buckets, larger values are grouped
+into buckets with relative width of at most 2 ** (1 - significant_bits).
+Histograms with the same significant_bits made on different tanks
+are merged by adding bucket counts, so quantiles of a test run by
+many tanks are computed without their phouts.
+
+File format (gzip-compressed json):
+    {
+    'format': 'latency_histograms',
+    'version': 1,
+    'unit': 'us',
+    'significant_bits': 7,
+    'seconds': [
+        {'ts': 1435255216, 'count': 1000, 'sum': 12345678, 'max': 98765,
+         'buckets': [[bucket index, count], ...]},
+        ...]
+    }
+"""
+
+import collections
+import gzip
+import io
+import itertools
+import json
+import operator
+import os
+
+import yandex_tank_api.phout as phout
+
+FORMAT = 'latency_histograms'
+FORMAT_VERSION = 1
+# Quantiles are estimated with relative error below 1/64
+SIGNIFICANT_BITS = 7
+DEFAULT_QUANTILES = [50, 75, 90, 95, 99, 99.9, 100]
+ARTIFACT_NAME = 'latency_histograms.json.gz'
+
+
+def bucket_index(value, significant_bits=SIGNIFICANT_BITS):
+    """Return index of the bucket for non-negative integer value"""
+    shift = value.bit_length() - significant_bits
+    if shift <= 0:
+        return value
+    return (shift << (significant_bits - 1)) + (value >> shift)
+
+
+def bucket_upper_bound(index, significant_bits=SIGNIFICANT_BITS):
+    """Return the largest value of the bucket"""
+    half = 1 << (significant_bits - 1)
+    if index < 2 * half:
+        return index
+    shift = index // half - 1
+    mantissa = index - shift * half
+    return ((mantissa + 1) << shift) - 1
+
+
+def quantile_name(quantile):
+    """Return key of the quantile in summaries: 50 -> '50', 99.9 -> '99.9'"""
+    return '{:g}'.format(quantile)
+
+
+class LatencyHistogram(object):
+    """Sparse log-linear histogram of response times"""
+
+    def __init__(self, significant_bits=SIGNIFICANT_BITS):
+        self.significant_bits = significant_bits
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def record_values(self, values):
+        """Add a list of non-negative integer values"""
+        if not values:
+            return
+        bits = self.significant_bits
+        half_bits = bits - 1
+        limit = 1 << bits
+        # bucket_index inlined, this is called for every phout line
+        self.buckets.update([
+            value if value < limit else
+            (shift << half_bits) + (value >> shift)
+            for value, shift in zip(
+                values, [value.bit_length() - bits for value in values])
+        ])
+        self.count += len(values)
+        self.sum += sum(values)
+        self.max = max(self.max, max(values))
+
+    def merge(self, other):
+        """Add counts of other histogram to this one"""
+        if other.significant_bits != self.significant_bits:
+            raise ValueError(
+                'Can not merge histograms with {} and {} significant bits'.
+                format(self.significant_bits, other.significant_bits))
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, quantile):
+        """
+        Return upper bound of the bucket containing the quantile (percent),
+        None for empty histogram
+        """
+        if not self.count:
+            return None
+        rank = quantile / 100.0 * self.count
+        cumulative = 0
+        for index in sorted(self.buckets):
+            cumulative += self.buckets[index]
+            if cumulative >= rank:
+                return min(
+                    bucket_upper_bound(index, self.significant_bits),
+                    self.max)
+        return self.max
+
+    def stats(self, quantiles=DEFAULT_QUANTILES):
+        """Return dict with count, mean, max and quantiles, in microseconds"""
+        return {
+            'count': self.count,
+            'mean': float(self.sum) / self.count if self.count else None,
+            'max': self.max if self.count else None,
+            'quantiles': dict(
+                (quantile_name(q), self.quantile(q)) for q in quantiles),
+        }
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'buckets': sorted(self.buckets.items()),
+        }
+
+    @classmethod
+    def from_dict(cls, data, significant_bits=SIGNIFICANT_BITS):
+        histogram = cls(significant_bits)
+        histogram.buckets.update(dict(
+            (int(index), count) for index, count in data['buckets']))
+        histogram.count = data['count']
+        histogram.sum = data['sum']
+        histogram.max = data['max']
+        return histogram
+
+
+class LatencyHistograms(object):
+    """Response time histograms of every second of a test"""
+
+    def __init__(self, significant_bits=SIGNIFICANT_BITS):
+        self.significant_bits = significant_bits
+        self.seconds = {}
+
+    def second(self, ts):
+        """Return histogram of the second, creating it if needed"""
+        histogram = self.seconds.get(ts)
+        if histogram is None:
+            histogram = self.seconds[ts] = LatencyHistogram(
+                self.significant_bits)
+        return histogram
+
+    def add_phout(self, filename, chunk_bytes=phout.READ_CHUNK_BYTES):
+        """Add interval_real of the phout lines, by second of receive time"""
+        for lines in phout.read_chunks(filename, chunk_bytes):
+            receive_ts, intervals = phout.parse_timings(lines)
+            # Lines are ordered by receive time, seconds come in runs
+            runs = itertools.groupby(
+                zip(map(int, receive_ts), intervals),
+                key=operator.itemgetter(0))
+            for ts, run in runs:
+                self.second(ts).record_values(
+                    [max(interval, 0) for _, interval in run])
+
+    def merge(self, other):
+        """Add histograms of other test or tank"""
+        if other.significant_bits != self.significant_bits:
+            raise ValueError(
+                'Can not merge histograms with {} and {} significant bits'.
+                format(self.significant_bits, other.significant_bits))
+        for ts, histogram in other.seconds.items():
+            self.second(ts).merge(histogram)
+
+    def total(self, since=None, until=None):
+        """Return histogram of all seconds in [since, until)"""
+        total = LatencyHistogram(self.significant_bits)
+        for ts, histogram in self.seconds.items():
+            if (since is None or ts >= since) \
+                    and (until is None or ts < until):
+                total.merge(histogram)
+        return total
+
+    def summary(self, quantiles=DEFAULT_QUANTILES, resolution=None):
+        """
+        Return {'overall': stats, 'intervals': [stats with ts, ...]},
+        intervals are resolution seconds long, omitted without resolution
+        """
+        reply = {'overall': self.total().stats(quantiles)}
+        if resolution is not None:
+            intervals = collections.OrderedDict()
+            for ts in sorted(self.seconds):
+                interval = intervals.setdefault(
+                    ts // resolution * resolution,
+                    LatencyHistogram(self.significant_bits))
+                interval.merge(self.seconds[ts])
+            reply['intervals'] = []
+            for ts, histogram in intervals.items():
+                stats = histogram.stats(quantiles)
+                stats['ts'] = ts
+                reply['intervals'].append(stats)
+        return reply
+
+    def to_dict(self):
+        seconds = []
+        for ts in sorted(self.seconds):
+            second = self.seconds[ts].to_dict()
+            second['ts'] = ts
+            seconds.append(second)
+        return {
+            'format': FORMAT,
+            'version': FORMAT_VERSION,
+            'unit': 'us',
+            'significant_bits': self.significant_bits,
+            'seconds': seconds,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get('format') != FORMAT \
+                or data.get('version') != FORMAT_VERSION:
+            raise ValueError('Not a latency histograms file')
+        histograms = cls(data['significant_bits'])
+        for second in data['seconds']:
+            histograms.seconds[second['ts']] = LatencyHistogram.from_dict(
+                second, histograms.significant_bits)
+        return histograms
+
+    def dumps(self):
+        """Return gzip-compressed json"""
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+            gz.write(json.dumps(
+                self.to_dict(), separators=(',', ':')).encode('utf-8'))
+        return buf.getvalue()
+
+    @classmethod
+    def loads(cls, data):
+        """Load gzip-compressed or plain json"""
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+        return cls.from_dict(json.loads(data.decode('utf-8')))
+
+    def save(self, filename):
+        """Write the file atomically, it may be downloaded meanwhile"""
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as target:
+            target.write(self.dumps())
+        os.rename(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as source:
+            return cls.loads(source.read())
+
+
+def from_phouts(filenames, significant_bits=SIGNIFICANT_BITS):
+    """Return histograms of the lines of all phout files"""
+    histograms = LatencyHistograms(significant_bits)
+    for filename in filenames:
+        histograms.add_phout(filename)
+    return histograms
+
+
+def merge_files(filenames):
+    """Return merged histograms of the files"""
+    merged = None
+    for filename in filenames:
+        histograms = LatencyHistograms.load(filename)
+        if merged is None:
+            merged = histograms
+        else:
+            merged.merge(histograms)
+    return merged if merged is not None else LatencyHistograms()
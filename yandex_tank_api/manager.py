@@ -4,6 +4,7 @@ Module that manages webserver and tank
 import os.path
 import os
 import signal
+import collections
 import multiprocessing
 import logging
 import logging.handlers
@@ -11,6 +12,12 @@ import traceback
 import six
 import time
 
+try:
+    from multiprocessing.connection import wait as wait_for_objects
+except ImportError:
+    # Python 2: no way to wait for queue and processes together
+    wait_for_objects = None
+
 import yandex_tank_api.common
 import yandex_tank_api.worker
 import yandex_tank_api.webserver
@@ -18,6 +25,34 @@ import yandex_tank_api.webserver
 
 _log = logging.getLogger(__name__)
 
+STATS_REPORT_INTERVAL = 1.0
+
+
+class SpareWorker(object):
+    """
+    Tank process started in advance.
+    It preloads plugins and waits until TankRunner assigns a session to it.
+    """
+
+    def __init__(self, cfg, manager_queue, machine_defaults=None):
+        self.tank_queue = multiprocessing.Queue()
+        self.tank_process = multiprocessing.Process(
+            target=yandex_tank_api.worker.run_spare,
+            args=(
+                self.tank_queue, manager_queue, cfg['ignore_machine_defaults'],
+                cfg['configs_location'], machine_defaults))
+        self.tank_process.start()
+
+    def is_alive(self):
+        """Check that the spare process didn't exit"""
+        return self.tank_process.exitcode is None
+
+    def stop(self):
+        """Terminate unused spare process"""
+        if self.is_alive():
+            self.tank_process.terminate()
+        self.tank_process.join()
+
 
 class TankRunner(object):
     """
@@ -25,10 +60,11 @@ class TankRunner(object):
     """
 
     def __init__(
-            self, cfg, manager_queue, session_id, tank_config, first_break):
+            self, cfg, manager_queue, session_id, tank_config, first_break,
+            requested_at=None, spare=None, cpus=None, machine_defaults=None):
         """
         Sets up working directory and tank queue
-        Starts tank process
+        Starts tank process or assigns the session to the spare one
         """
 
         work_dir = os.path.join(cfg['tests_dir'], session_id)
@@ -40,29 +76,59 @@ class TankRunner(object):
         with open(load_ini_path, 'w') as tank_config_file:
             tank_config_file.write(six.ensure_str(tank_config))
 
+        worker_args = {
+            'work_dir': work_dir,
+            'lock_dir': lock_dir,
+            'session_id': session_id,
+            'ignore_machine_defaults': cfg['ignore_machine_defaults'],
+            'configs_location': cfg['configs_location'],
+            'status_max_rate': cfg['status_max_rate'],
+            'requested_at': requested_at,
+            'cpus': cpus,
+            'shared_lock': cfg['max_sessions'] > 1,
+            'lock_wait_timeout': cfg['lock_wait_timeout'],
+            'machine_defaults': machine_defaults,
+        }
+
+        if spare is not None and spare.is_alive():
+            # Assign session to the spare tank process
+            _log.info('Using spare tank process %s', spare.tank_process.pid)
+            self.tank_queue = spare.tank_queue
+            self.tank_process = spare.tank_process
+            self.tank_queue.put({'assign': worker_args})
+            self.set_break(first_break)
+            return
+
         # Create tank queue and put first break there
         self.tank_queue = multiprocessing.Queue()
         self.set_break(first_break)
 
-        ignore_machine_defaults = cfg['ignore_machine_defaults']
-        configs_location = cfg['configs_location']
-
         # Start tank process
         self.tank_process = multiprocessing.Process(
             target=yandex_tank_api.worker.run,
-            args=(
-                self.tank_queue, manager_queue, work_dir, lock_dir, session_id,
-                ignore_machine_defaults, configs_location))
+            args=(self.tank_queue, manager_queue),
+            kwargs=worker_args)
         self.tank_process.start()
 
-    def set_break(self, next_break):
-        """Sends the next break to the tank process"""
-        self.tank_queue.put({'break': next_break})
+    def set_break(self, next_break, start_at=None):
+        """
+        Sends the next break to the tank process.
+        With start_at, the tank leaves its current break at that time.
+        """
+        msg = {'break': next_break}
+        if start_at is not None:
+            msg['start_at'] = start_at
+        self.tank_queue.put(msg)
 
     def is_alive(self):
         """Check that the tank process didn't exit """
         return self.tank_process.exitcode is None
 
+    @property
+    def sentinel(self):
+        """Object that becomes ready when the tank process exits"""
+        return self.tank_process.sentinel
+
     def get_exitcode(self):
         """Return tank exitcode"""
         return self.tank_process.exitcode
@@ -99,39 +165,98 @@ class Manager(object):
             target=yandex_tank_api.webserver.main,
             args=(
                 self.webserver_queue, self.manager_queue, cfg['tests_dir'],
-                cfg['tornado_debug']))
+                cfg['tornado_debug'], cfg['upload_size_limit'],
+                cfg['max_sessions'], cfg['session_queue_limit'],
+                cfg['configs_location']))
         self.webserver_process.daemon = True
         self.webserver_process.start()
 
-        self._reset_session(ignore_disposable=True)
+        self.spare = None
+        self.tank_runners = {}
+        self.last_tank_statuses = {}
+        self.cpu_slots = {}
+        self.unlocked_sessions = set()
+        self.stats = collections.Counter()
+        self.reported_stats = None
+        self.stats_reported_at = 0
+        self.machine_defaults = None
+        if not cfg['ignore_machine_defaults']:
+            self.machine_defaults = yandex_tank_api.worker.MachineDefaults(
+                cfg['configs_location'])
+        self._prepare_spare()
+
+    def _prepare_spare(self):
+        """Start spare tank process if required and not running yet"""
+        if not self.cfg['spare_worker'] or self.cfg['disposable']:
+            return
+        if self.spare is None or not self.spare.is_alive():
+            self.spare = SpareWorker(
+                self.cfg, self.manager_queue, self._machine_defaults())
+            self.stats['spare_workers_started'] += 1
+
+    def _machine_defaults(self):
+        """
+        Return parsed machine default configs for worker
+        or None to let worker read them itself
+        """
+        if self.machine_defaults is None:
+            return None
+        try:
+            return self.machine_defaults.get()
+        except Exception:
+            _log.warning('Failed to load machine defaults', exc_info=True)
+            return None
+
+    def _report_stats(self):
+        """Send changed counters to webserver, at most once per interval"""
+        now = time.time()
+        if self.stats == self.reported_stats \
+                or now < self.stats_reported_at + STATS_REPORT_INTERVAL:
+            return
+        self.reported_stats = collections.Counter(self.stats)
+        self.stats_reported_at = now
+        self.webserver_queue.put({'manager_stats': dict(self.stats)})
+
+    def _stop_spare(self):
+        """Stop spare tank process, if any"""
+        if self.spare is not None:
+            self.spare.stop()
+            self.spare = None
 
-    def _reset_session(self, ignore_disposable=False):
+    def _reset_session(self, session_id):
         """
-        Resets session state variables
-        Should be called only when tank is not running
+        Forgets session state
+        Should be called only when its tank is not running
         """
-        if self.cfg['disposable'] and not ignore_disposable:
+        _log.info('Resetting session %s variables', session_id)
+        self.tank_runners.pop(session_id, None)
+        self.last_tank_statuses.pop(session_id, None)
+        self.cpu_slots.pop(session_id, None)
+        self.unlocked_sessions.discard(session_id)
+        if self.cfg['disposable'] and not self.tank_runners:
             raise KeyboardInterrupt()
-        _log.info('Resetting current session variables')
-        self.session_id = None
-        self.tank_runner = None
-        self.last_tank_status = 'not started'
+
+    def _take_cpu_slot(self, session_id):
+        """Return free CPU set for the session or None"""
+        busy = set(self.cpu_slots.values())
+        for slot, cpus in enumerate(self.cfg['session_cpus']):
+            if slot not in busy:
+                self.cpu_slots[session_id] = slot
+                return cpus
+        return None
 
     def _handle_cmd_stop(self, msg):
         """Check running session and kill tank"""
-        if msg['session'] == self.session_id:
-            self.tank_runner.stop(remove_break=False)
+        if msg['session'] in self.tank_runners:
+            self.tank_runners[msg['session']].stop(remove_break=False)
         else:
-            _log.error('Can stop only current session')
+            _log.error('Can stop only running session')
 
     def _handle_cmd_set_break(self, msg):
         """New break for running session"""
-        if msg['session'] != self.session_id:
-            raise RuntimeError(
-                'Webserver requested to start session '
-                'when another one is already running')
-        elif 'break' in msg:
-            self.tank_runner.set_break(msg['break'])
+        if 'break' in msg:
+            self.tank_runners[msg['session']].set_break(
+                msg['break'], msg.get('start_at'))
         else:
             # Internal protocol error
             _log.error(
@@ -145,25 +270,49 @@ class Manager(object):
                 'Not enough data to start new session: '
                 'both config and test should be present:%s\n', msg)
             return
+        session_id = msg['session']
+        # Sessions that have released the lock do not occupy a slot
+        if len(self.tank_runners) - len(self.unlocked_sessions) \
+                >= self.cfg['max_sessions']:
+            self.stats['sessions_refused'] += 1
+            self.webserver_queue.put({
+                'session': session_id,
+                'status': 'failed',
+                'break': msg['break'],
+                'reason': 'Too many sessions are running'
+            })
+            return
+        spare, self.spare = self.spare, None
         try:
             print(msg)
-            self.tank_runner = TankRunner(
+            self.tank_runners[session_id] = TankRunner(
                 cfg=self.cfg,
                 manager_queue=self.manager_queue,
-                session_id=msg['session'],
+                session_id=session_id,
                 tank_config=msg['config'],
-                first_break=msg['break'])
+                first_break=msg['break'],
+                requested_at=msg.get('requested_at', time.time()),
+                spare=spare,
+                cpus=self._take_cpu_slot(session_id),
+                machine_defaults=self._machine_defaults())
         except KeyboardInterrupt:
             pass
         except Exception as ex:
+            self.stats['session_start_failures'] += 1
+            self.cpu_slots.pop(session_id, None)
             self.webserver_queue.put({
-                'session': msg['session'],
+                'session': session_id,
                 'status': 'failed',
                 'break': msg['break'],
                 'reason': 'Failed to start tank:\n' + traceback.format_exc(ex)
             })
         else:
-            self.session_id = msg['session']
+            self.stats['sessions_started'] += 1
+            self.last_tank_statuses[session_id] = 'not started'
+        finally:
+            if spare is not None and session_id not in self.tank_runners:
+                spare.stop()
+            self._prepare_spare()
 
     def _handle_cmd(self, msg):
         """Process command from webserver"""
@@ -177,51 +326,81 @@ class Manager(object):
         if cmd == 'stop':
             self._handle_cmd_stop(msg)
         elif cmd == 'run':
-            if self.session_id is not None:
+            if msg['session'] in self.tank_runners:
                 self._handle_cmd_set_break(msg)
             else:
                 self._handle_cmd_new_session(msg)
         else:
             _log.critical('Unknown command: %s', cmd)
 
-    def _handle_tank_exit(self):
+    def _handle_tank_exit(self, session_id):
         """
         Empty manager queue.
         Report if tank died unexpectedly.
         Reset session.
         """
-        logging.info('Tank exit, sleeping 1 s and handling remaining messages')
-        time.sleep(1)
-        while True:
-            try:
-                msg = self.manager_queue.get(block=False)
-            except multiprocessing.queues.Empty:
-                break
-            self._handle_msg(msg)
-        if self.last_tank_status == 'running'\
-                or not self.tank_runner\
-                or self.tank_runner.get_exitcode() != 0:
+        _log.info('Tank exit, handling remaining messages')
+        # Queue feeder thread of the tank process is joined at its exit,
+        # so all the messages it sent are already in the pipe
+        self._handle_queued_messages()
+        if session_id not in self.tank_runners:
+            # The session is already reset
+            return
+        tank_runner = self.tank_runners[session_id]
+        last_tank_status = self.last_tank_statuses[session_id]
+        died = last_tank_status == 'running' \
+            or tank_runner.get_exitcode() != 0
+        # Exit after the final status is expected
+        if died and last_tank_status not in ['success', 'failed']:
             # Report unexpected death
+            self.stats['tank_deaths'] += 1
             self.webserver_queue.put({
-                'session': self.session_id,
+                'session': session_id,
                 'status': 'failed',
                 'reason': 'Tank died unexpectedly. Last reported '
                 'status: % s, worker exitcode: % s' % (
-                    self.last_tank_status,
-                    self.tank_runner.get_exitcode() if self.tank_runner else None)
+                    last_tank_status, tank_runner.get_exitcode())
             })
         # In any case, reset the session
-        self._reset_session()
+        self._reset_session(session_id)
 
     def _handle_webserver_exit(self):
         """Stop tank and raise RuntimeError"""
         _log.error('Webserver died unexpectedly.')
-        if self.tank_runner is not None:
+        for tank_runner in self.tank_runners.values():
             _log.warning('Stopping tank...')
-            self.tank_runner.stop(remove_break=True)
-            self.tank_runner.join()
+            tank_runner.stop(remove_break=True)
+            tank_runner.join()
         raise RuntimeError('Unexpected webserver exit')
 
+    def _handle_queued_messages(self):
+        """Handle all messages that are already in manager queue"""
+        while True:
+            try:
+                msg = self.manager_queue.get(block=False)
+            except multiprocessing.queues.Empty:
+                return
+            self._handle_msg(msg)
+
+    def _wait_events(self):
+        """
+        Wait until a message arrives or tank or webserver exits,
+        but no longer than message_check_interval
+        """
+        timeout = self.cfg['message_check_interval']
+        if wait_for_objects is None:
+            try:
+                msg = self.manager_queue.get(block=True, timeout=timeout)
+            except multiprocessing.queues.Empty:
+                return
+            self._handle_msg(msg)
+            return
+        # pylint: disable=W0212
+        waited = [self.manager_queue._reader, self.webserver_process.sentinel]
+        waited.extend(
+            tank_runner.sentinel for tank_runner in self.tank_runners.values())
+        wait_for_objects(waited, timeout)
+
     def run(self):
         """
         Manager event loop.
@@ -230,20 +409,27 @@ class Manager(object):
         Check that webserver is alive.
         """
 
-        while True:
-            if self.session_id is not None and not self.tank_runner.is_alive():
-                self._handle_tank_exit()
-            if not self.webserver_process.is_alive():
-                self._handle_webserver_exit()
-            try:
-                msg = self.manager_queue.get(
-                    block=True, timeout=self.cfg['message_check_interval'])
-            except multiprocessing.queues.Empty:
-                continue
-            self._handle_msg(msg)
+        try:
+            while True:
+                for session_id, tank_runner in list(self.tank_runners.items()):
+                    if not tank_runner.is_alive():
+                        self._handle_tank_exit(session_id)
+                if not self.webserver_process.is_alive():
+                    self._handle_webserver_exit()
+                self._wait_events()
+                self._handle_queued_messages()
+                self._report_stats()
+        finally:
+            self._stop_spare()
 
     def _handle_msg(self, msg):
         """Handle message from manager queue"""
+        self.stats['messages'] += 1
+        if 'live_metrics' in msg:
+            # Load metrics from tank, sent every second,
+            # only the webserver needs them
+            self.webserver_queue.put(msg)
+            return
         _log.info('Recieved message:\n%s', msg)
         if 'cmd' in msg:
             # Recieved command from server
@@ -256,19 +442,19 @@ class Manager(object):
 
     def _handle_tank_status(self, msg):
         """
-        Wait for tank exit if it stopped.
         Remember new status and notify webserver.
+        Session of a stopped tank is reset when its process exits.
         """
+        session_id = msg['session']
         new_status = msg['status']
 
-        if self.last_tank_status not in ['success', 'failed'] \
-                and new_status in ['success', 'failed']:
-            self.tank_runner.join()
-            self._reset_session()
-
-        self.last_tank_status = msg['status']
-
         self.webserver_queue.put(msg)
+        if session_id not in self.tank_runners:
+            return
+        self.last_tank_statuses[session_id] = new_status
+        if yandex_tank_api.common.has_released_lock(msg):
+            self.unlocked_sessions.add(session_id)
+            self.cpu_slots.pop(session_id, None)
 
 
 def run_server(options):
@@ -284,6 +470,16 @@ def run_server(options):
         'lock_dir': options.lock_dir,
         'configs_location': options.configs_location,
         'disposable': options.disposable,
+        'upload_size_limit': options.upload_size_limit,
+        'status_max_rate': options.status_max_rate,
+        'spare_worker': options.spare_worker,
+        'max_sessions': options.max_sessions,
+        'session_queue_limit': options.session_queue_limit,
+        'lock_wait_timeout': options.lock_wait_timeout,
+        'session_cpus': [
+            yandex_tank_api.common.parse_cpu_list(spec)
+            for spec in options.session_cpus
+        ],
     }
 
     root_logger = logging.getLogger()
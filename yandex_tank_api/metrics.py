@@ -0,0 +1,159 @@
+"""
+Internal metrics of yandex-tank-api
+in Prometheus text and OpenMetrics exposition formats
+"""
+
+import collections
+import math
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_CONTENT_TYPE = \
+    'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+REQUEST_DURATION_BUCKETS = [
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+]
+STATUS_LAG_BUCKETS = [
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5
+]
+
+
+class Histogram(object):
+    """Cumulative histogram with fixed bucket bounds"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+def format_value(value):
+    """Format sample value"""
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def format_labels(labels):
+    """Format label set, labels is a list of (name, value) pairs"""
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+                '\n', '\\n')) for name, value in labels) + '}'
+
+
+class Metrics(object):
+    """
+    Counters and histograms of the webserver process.
+    Gauges and manager counters are collected at scrape time.
+    Not thread-safe: should be updated from the IOLoop thread only.
+    """
+
+    def __init__(self):
+        self.requests = collections.Counter()
+        self.request_durations = {}
+        self.response_bytes = collections.Counter()
+        self.status_messages = collections.Counter()
+        self.status_lag = Histogram(STATUS_LAG_BUCKETS)
+        self.manager_stats = {}
+
+    def observe_request(self, handler, method, code, duration):
+        self.requests[(handler, method, code)] += 1
+        if handler not in self.request_durations:
+            self.request_durations[handler] = Histogram(
+                REQUEST_DURATION_BUCKETS)
+        self.request_durations[handler].observe(duration)
+
+    def count_response_bytes(self, handler, size):
+        self.response_bytes[handler] += size
+
+    def observe_status_message(self, status, lag=None):
+        self.status_messages[status] += 1
+        if lag is not None:
+            self.status_lag.observe(max(lag, 0.0))
+
+    def render(self, gauges, openmetrics=False):
+        """
+        Return metrics text.
+        gauges is a list of (name, help, [(labels, value), ...]),
+        gauges with None value are skipped.
+        """
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            # OpenMetrics names counter families without the _total suffix
+            family_name = name[:-len('_total')] \
+                if openmetrics and kind == 'counter' else name
+            lines.append('# TYPE {} {}'.format(family_name, kind))
+            lines.append('# HELP {} {}'.format(family_name, help_text))
+            for suffix, labels, value in samples:
+                lines.append('{}{}{} {}'.format(
+                    name, suffix, format_labels(labels), format_value(value)))
+
+        def histogram_samples(histogram, labels):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                yield '_bucket', labels + [
+                    ('le', format_value(float(bound)))], cumulative
+            yield '_bucket', labels + [('le', '+Inf')], histogram.count
+            yield '_count', labels, histogram.count
+            yield '_sum', labels, histogram.sum
+
+        family(
+            'tank_api_requests_total', 'counter',
+            'HTTP requests handled by the API server',
+            [('', [('handler', handler), ('method', method), ('code', code)],
+              count)
+             for (handler, method, code), count in sorted(
+                 self.requests.items())])
+        family(
+            'tank_api_request_duration_seconds', 'histogram',
+            'HTTP request handling time',
+            [sample
+             for handler, histogram in sorted(self.request_durations.items())
+             for sample in histogram_samples(
+                 histogram, [('handler', handler)])])
+        family(
+            'tank_api_response_bytes_total', 'counter',
+            'Response body bytes written before compression',
+            [('', [('handler', handler)], size)
+             for handler, size in sorted(self.response_bytes.items())])
+        family(
+            'tank_api_status_messages_total', 'counter',
+            'Session status messages received from the manager',
+            [('', [('status', status)], count)
+             for status, count in sorted(self.status_messages.items())])
+        family(
+            'tank_api_status_lag_seconds', 'histogram',
+            'Time from worker status report until the webserver received it',
+            list(histogram_samples(self.status_lag, [])))
+        for name, count in sorted(self.manager_stats.items()):
+            family(
+                'tank_api_manager_{}_total'.format(name), 'counter',
+                'Manager counter: {}'.format(name.replace('_', ' ')),
+                [('', [], count)])
+        for name, help_text, samples in gauges:
+            samples = [
+                ('', labels, value) for labels, value in samples
+                if value is not None
+            ]
+            if samples:
+                family(name, 'gauge', help_text, samples)
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,192 @@
+"""
+Reading and merging of phout files
+
+Phout line: tab separated
+    send_ts (unix time, s), tag, interval_real (us), connect_time,
+    send_time, latency, receive_time, interval_event, size_out, size_in,
+    net_code, proto_code
+
+Load generators write a line when the response is received,
+so lines of a phout are ordered by receive time (send_ts + interval_real).
+"""
+
+import bisect
+import heapq
+import logging
+import operator
+
+_log = logging.getLogger(__name__)
+
+READ_CHUNK_BYTES = 4 * 1024 * 1024
+WRITE_BUFFER_BYTES = 4 * 1024 * 1024
+
+_split_fields = operator.methodcaller('split', b'\t', 3)
+_ts_fields = operator.itemgetter(0, 2)
+
+
+def receive_ts(line):
+    """Return receive time of the phout line, seconds"""
+    fields = line.split(b'\t', 3)
+    return float(fields[0]) + int(fields[2]) * 1e-6
+
+
+def parse_receive_ts(lines):
+    """
+    Return (keys, lines) for a batch of lines,
+    lines that are empty or malformed are dropped
+    """
+    try:
+        # Same as receive_ts, without a function call per line
+        return [
+            float(send_ts) + int(interval_real) * 1e-6
+            for send_ts, interval_real in map(
+                _ts_fields, map(_split_fields, lines))
+        ], lines
+    except (ValueError, IndexError):
+        pass
+    keys, good_lines = [], []
+    for line in lines:
+        try:
+            keys.append(receive_ts(line))
+        except (ValueError, IndexError):
+            if line.strip():
+                _log.warning('Malformed phout line: %r', line[:200])
+            continue
+        good_lines.append(line)
+    return keys, good_lines
+
+
+def parse_timings(lines):
+    """
+    Return (receive times, interval_real values) for a batch of lines,
+    lines that are empty or malformed are skipped
+    """
+    try:
+        fields = [
+            (float(send_ts), int(interval_real))
+            for send_ts, interval_real in map(
+                _ts_fields, map(_split_fields, lines))
+        ]
+    except (ValueError, IndexError):
+        fields = []
+        for line in lines:
+            try:
+                send_ts, interval_real = _ts_fields(_split_fields(line))
+                fields.append((float(send_ts), int(interval_real)))
+            except (ValueError, IndexError):
+                if line.strip():
+                    _log.warning('Malformed phout line: %r', line[:200])
+    intervals = [interval_real for _, interval_real in fields]
+    return [
+        send_ts + interval_real * 1e-6 for send_ts, interval_real in fields
+    ], intervals
+
+
+def read_chunks(filename, chunk_bytes=READ_CHUNK_BYTES):
+    """
+    Yield lists of complete lines (without newlines) of the file,
+    reading it in big chunks
+    """
+    with open(filename, 'rb', 0) as phout:
+        tail = b''
+        while True:
+            data = phout.read(chunk_bytes)
+            if not data:
+                break
+            lines = data.split(b'\n')
+            lines[0] = tail + lines[0]
+            tail = lines.pop()
+            if lines:
+                yield lines
+        if tail:
+            yield [tail]
+
+
+class ChunkReader(object):
+    """
+    Phout lines and their receive times, a chunk at a time.
+    Lines within a chunk are sorted, to tolerate slightly unordered input.
+    """
+
+    def __init__(self, filename, chunk_bytes=READ_CHUNK_BYTES):
+        self.filename = filename
+        self._chunks = read_chunks(filename, chunk_bytes)
+        self.keys = []
+        self.lines = []
+        self.pos = 0
+
+    def refill(self):
+        """Read the next chunk, return False at EOF"""
+        for lines in self._chunks:
+            keys, lines = parse_receive_ts(lines)
+            if not keys:
+                continue
+            if any(a > b for a, b in zip(keys, keys[1:])):
+                order = sorted(range(len(keys)), key=keys.__getitem__)
+                keys = [keys[i] for i in order]
+                lines = [lines[i] for i in order]
+            self.keys, self.lines, self.pos = keys, lines, 0
+            return True
+        self.keys, self.lines, self.pos = [], [], 0
+        return False
+
+    @property
+    def last_key(self):
+        return self.keys[-1]
+
+    def take_until(self, key):
+        """Return (keys, lines) of buffered lines with receive time <= key"""
+        start = self.pos
+        self.pos = bisect.bisect_right(self.keys, key, start)
+        return self.keys[start:self.pos], self.lines[start:self.pos]
+
+
+def merge_phouts(
+        filenames, outfilename, chunk_bytes=READ_CHUNK_BYTES,
+        write_buffer_bytes=WRITE_BUFFER_BYTES):
+    """
+    Merge phout files ordered by receive time into one ordered file.
+    Return number of lines written.
+
+    The heap holds the readers ordered by the last receive time
+    in their buffered chunk. The smallest one is the watermark:
+    all buffered lines up to it can be written,
+    after that the readers with exhausted chunks are refilled.
+    Lines of one batch are ordered with timsort,
+    which merges the sorted runs of the readers in C.
+    """
+    readers = []
+    heap = []
+    for filename in filenames:
+        reader = ChunkReader(filename, chunk_bytes)
+        if reader.refill():
+            heap.append((reader.last_key, len(readers)))
+        readers.append(reader)
+    heapq.heapify(heap)
+
+    written = 0
+    with open(outfilename, 'wb', write_buffer_bytes) as outfile:
+        while heap:
+            watermark = heap[0][0]
+            batch_keys, batch_lines = [], []
+            runs = 0
+            for _, i in heap:
+                keys, lines = readers[i].take_until(watermark)
+                if keys:
+                    batch_keys.extend(keys)
+                    batch_lines.extend(lines)
+                    runs += 1
+            if runs > 1:
+                order = sorted(
+                    range(len(batch_keys)), key=batch_keys.__getitem__)
+                batch_lines = [batch_lines[i] for i in order]
+            batch_lines.append(b'')
+            outfile.write(b'\n'.join(batch_lines))
+            written += len(batch_lines) - 1
+
+            # Readers that gave all their buffered lines are at the top
+            while heap and heap[0][0] <= watermark:
+                _, i = heapq.heappop(heap)
+                if readers[i].refill():
+                    heapq.heappush(heap, (readers[i].last_key, i))
+    return written
@@ -0,0 +1,151 @@
+"""
+Persistent index of session statuses for yandex-tank-api
+"""
+
+import json
+import logging
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+INDEX_FILENAME = '.sessions.sqlite'
+FINAL_STATUSES = ['success', 'failed']
+
+_log = logging.getLogger(__name__)
+
+
+class SessionRegistry(object):
+    """
+    SQLite index of session statuses kept in the tests directory.
+    Sessions missing from the index are loaded from their status.json.
+    Thread-safe: the index is also filled from the IO thread pool.
+    """
+
+    def __init__(self, tests_dir):
+        self.tests_dir = tests_dir
+        if not os.path.isdir(tests_dir):
+            os.makedirs(tests_dir)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(tests_dir, INDEX_FILENAME), check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                'id TEXT PRIMARY KEY, status TEXT, updated REAL, data TEXT)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS sessions_updated '
+                'ON sessions (updated)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS sessions_status '
+                'ON sessions (status, updated)')
+
+    @staticmethod
+    def _as_failed(status, reason):
+        """Return copy of unfinished status marked as failed"""
+        status = dict(status)
+        status['status'] = 'failed'
+        status['reason'] = reason
+        return status
+
+    def _read_status_file(self, session_id):
+        """Return index row made from status.json or None"""
+        path = os.path.join(self.tests_dir, session_id, 'status.json')
+        try:
+            with open(path) as status_file:
+                status = json.load(status_file)
+            updated = os.stat(path).st_mtime
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(status, dict) or 'status' not in status:
+            return None
+        status.pop('session', None)
+        if status['status'] not in FINAL_STATUSES:
+            status = self._as_failed(
+                status, 'Session was not finished when the index was built')
+        return session_id, status['status'], updated, json.dumps(status)
+
+    def put(self, session_id, status):
+        """Store new session status"""
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)',
+                (session_id, status['status'], time.time(), json.dumps(status)))
+
+    def get(self, session_id):
+        """Get session status by ID, can raise KeyError"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT data FROM sessions WHERE id = ?',
+                (session_id, )).fetchone()
+        if row is not None:
+            return json.loads(row[0])
+        row = self._read_status_file(session_id)
+        if row is None:
+            raise KeyError(session_id)
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR IGNORE INTO sessions VALUES (?, ?, ?, ?)', row)
+        return json.loads(row[3])
+
+    def find(
+            self, statuses=None, since=None, until=None, limit=None,
+            offset=0):
+        """
+        Return list of (session_id, status) pairs, most recent first,
+        and the total number of sessions matching the filter.
+        since and until limit the time of the last status update.
+        """
+        where, params = [], []
+        if statuses:
+            where.append(
+                'status IN ({})'.format(', '.join('?' * len(statuses))))
+            params.extend(statuses)
+        if since is not None:
+            where.append('updated >= ?')
+            params.append(since)
+        if until is not None:
+            where.append('updated < ?')
+            params.append(until)
+        clause = ' WHERE ' + ' AND '.join(where) if where else ''
+        query = 'SELECT id, data FROM sessions{} ' \
+            'ORDER BY updated DESC LIMIT ? OFFSET ?'.format(clause)
+        with self._lock:
+            total = self._db.execute(
+                'SELECT COUNT(*) FROM sessions' + clause, params).fetchone()[0]
+            rows = self._db.execute(
+                query,
+                params + [limit if limit is not None else -1, offset]).fetchall()
+        return [(session_id, json.loads(data)) for session_id, data in rows], total
+
+    def fail_unfinished(self, reason):
+        """Mark sessions left unfinished by previous server run as failed"""
+        with self._lock, self._db:
+            rows = self._db.execute(
+                'SELECT id, data FROM sessions WHERE status NOT IN (?, ?)',
+                FINAL_STATUSES).fetchall()
+            for session_id, data in rows:
+                status = self._as_failed(json.loads(data), reason)
+                self._db.execute(
+                    'UPDATE sessions SET status = ?, data = ? WHERE id = ?',
+                    (status['status'], json.dumps(status), session_id))
+
+    def sync(self):
+        """Index sessions that have status.json but are missing from the index"""
+        with self._lock:
+            known = set(
+                row[0] for row in self._db.execute('SELECT id FROM sessions'))
+        rows = []
+        for session_id in os.listdir(self.tests_dir):
+            if session_id in known:
+                continue
+            row = self._read_status_file(session_id)
+            if row is not None:
+                rows.append(row)
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO sessions VALUES (?, ?, ?, ?)', rows)
+        _log.info('Added %s sessions to the index', len(rows))
@@ -3,24 +3,403 @@
 Yandex.Tank HTTP API: request handling code
 """
 
+import tornado.escape
+import tornado.gen
 import tornado.httpserver
 import tornado.ioloop
+import tornado.iostream
+import tornado.locks
 import tornado.web
 import os.path
 import os
 import json
+import stat
 import uuid
 import multiprocessing
+import concurrent.futures
 import datetime
+import email.utils
+import fnmatch
+import functools
+import hashlib
+import heapq
+import itertools
+import logging
 import time
+import tarfile
 import yaml
+import zlib
+import collections
 import yandex_tank_api.common as common
+import yandex_tank_api.latency as latency
+import yandex_tank_api.metrics as metrics
+import yandex_tank_api.sessions as sessions
+import yandex_tank_api.worker as worker
 from retrying import retry
 from yandextank.validator.validator import TankConfig
-from yandextank.core.consoleworker import load_core_base_cfg, load_local_base_cfgs
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+_log = logging.getLogger(__name__)
 
 TRANSFER_SIZE_LIMIT = 128 * 1024
+UPLOAD_SIZE_LIMIT = 32 * 1024 * 1024 * 1024
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+FILE_IO_THREADS = 4
+MAX_BYTE_RANGES = 64
+TAIL_SIZE_LIMIT = TRANSFER_SIZE_LIMIT
+TAIL_RATE_LIMIT = 1024 * 1024
+# Files like tank.log grow without messages from the tank
+TAIL_RECHECK_INTERVAL = 1.0
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSED_CACHE_DIR = '.compressed'
+# Files being written: uploads, status.json and histograms before rename
+TMP_SUFFIX = '.tmp'
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+VALIDATION_THREADS = 2
+VALIDATION_CACHE_SIZE = 256
+MANIFEST_CACHE_SIZE = 64
+FINISHED_STATUS_CACHE_SIZE = 1024
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+TAR_END = b'\0' * (2 * tarfile.BLOCKSIZE)
+ARCHIVE_TYPES = {
+    None: ('application/x-tar', '.tar'),
+    'gzip': ('application/gzip', '.tar.gz'),
+    'zstd': ('application/zstd', '.tar.zst'),
+}
 DEFAULT_HEARTBEAT_TIMEOUT = 600
+STATUS_DRAIN_INTERVAL = 0.05
+STATUS_WAIT_TIMEOUT = 30
+STATUS_WAIT_TIMEOUT_MAX = 300
+SESSION_QUEUE_LIMIT = 64
+DURATION_HISTORY = 16
+TIMINGS_HISTORY_LIMIT = 100
+TIMINGS_HISTORY_LIMIT_MAX = 1000
+TIMING_PERCENTILES = [50, 90, 99]
+LIVE_METRICS_SECONDS = 3600
+LIVE_METRICS_SESSIONS = 16
+
+
+def parse_byte_ranges(header, size):
+    """
+    Parse Range header value into a list of (start, end) pairs,
+    end is exclusive.
+    Returns None if the header should be ignored
+    and an empty list if no range is satisfiable.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes':
+        return None
+    ranges = []
+    for part in spec.split(','):
+        first, sep, last = part.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if not first:
+                start, end = max(size - int(last), 0), size
+            else:
+                start = int(first)
+                end = min(int(last) + 1, size) if last else size
+                if last and int(last) < start:
+                    return None
+        except ValueError:
+            return None
+        if start < end:
+            ranges.append((start, end))
+    if len(ranges) > MAX_BYTE_RANGES:
+        return None
+    return ranges
+
+
+def read_file_range(filepath, offset, length):
+    """Read up to length bytes starting from offset"""
+    with open(filepath, 'rb') as source:
+        source.seek(offset)
+        return source.read(length)
+
+
+def validate_config(base_configs, config):
+    """
+    Validate config on top of base configs, return list of errors.
+    Runs in the validation thread pool.
+    """
+    _, errors, _ = TankConfig(
+        base_configs + [config], with_dynamic_options=False).validate()
+    return errors
+
+
+def scan_artifacts(basepath, previous=None):
+    """
+    Return list of artifact entries (name, size, mtime) sorted by name.
+    Hashes are taken from the previous entries of unchanged files,
+    files removed during the scan and temporary files are skipped.
+    Runs in the IO thread pool.
+    """
+    known = dict((entry['name'], entry) for entry in previous or [])
+    entries = []
+    for name in sorted(os.listdir(basepath)):
+        if name.endswith(TMP_SUFFIX):
+            continue
+        path = os.path.join(basepath, name)
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            continue
+        if not stat.S_ISREG(file_stat.st_mode):
+            continue
+        entry = {
+            'name': name,
+            'size': file_stat.st_size,
+            'mtime': file_stat.st_mtime
+        }
+        old = known.get(name)
+        if old is not None and 'sha256' in old \
+                and (old['size'], old['mtime']) == (entry['size'], entry['mtime']):
+            entry['sha256'] = old['sha256']
+        entries.append(entry)
+    return entries
+
+
+def file_sha256(filepath):
+    """Return hex SHA-256 of the file contents"""
+    checksum = hashlib.sha256()
+    with open(filepath, 'rb') as source:
+        while True:
+            chunk = source.read(TRANSFER_CHUNK_SIZE)
+            if not chunk:
+                break
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def summarize_durations(durations):
+    """Return distribution summary of a list of durations"""
+    durations = sorted(durations)
+    summary = collections.OrderedDict([
+        ('count', len(durations)),
+        ('min', durations[0]),
+        ('mean', sum(durations) / len(durations)),
+    ])
+    for percentile in TIMING_PERCENTILES:
+        index = int(round(percentile / 100.0 * (len(durations) - 1)))
+        summary['p{}'.format(percentile)] = durations[index]
+    summary['max'] = durations[-1]
+    return summary
+
+
+def aggregate_timings(statuses):
+    """Return distributions of stage and plugin durations of sessions"""
+    stages = collections.defaultdict(list)
+    plugins = collections.defaultdict(lambda: collections.defaultdict(list))
+    for status in statuses:
+        for stage, timing in (status.get('timings') or {}).items():
+            if 'duration' in timing:
+                stages[stage].append(timing['duration'])
+        for stage, durations in (status.get('plugin_timings') or {}).items():
+            for plugin_name, duration in durations.items():
+                plugins[stage][plugin_name].append(duration)
+
+    def by_order(stage):
+        if stage in common.TEST_STAGE_ORDER:
+            return common.TEST_STAGE_ORDER.index(stage)
+        return len(common.TEST_STAGE_ORDER)
+
+    return {
+        'sessions': len(statuses),
+        'stages': collections.OrderedDict(
+            (stage, summarize_durations(stages[stage]))
+            for stage in sorted(stages, key=by_order)),
+        'plugins': collections.OrderedDict(
+            (stage, collections.OrderedDict(
+                (plugin_name, summarize_durations(durations))
+                for plugin_name, durations in sorted(plugins[stage].items())))
+            for stage in sorted(plugins, key=by_order)),
+    }
+
+
+def hist_quantile(bins, counts, total, quantile):
+    """Return upper bound of the histogram bin containing the quantile"""
+    rank = quantile / 100.0 * total
+    cumulative = 0
+    for bound, count in zip(bins, counts):
+        cumulative += count
+        if cumulative >= rank:
+            return bound
+    return bins[-1] if bins else None
+
+
+def downsample_live_metrics(points, resolution, with_hist=False):
+    """
+    Merge per-second load metrics into intervals of resolution seconds.
+    Rates are averaged over the seconds with data,
+    quantiles are estimated from the merged response time histogram.
+    """
+    intervals = collections.OrderedDict()
+    for point in points:
+        intervals.setdefault(
+            point['ts'] // resolution * resolution, []).append(point)
+    merged = []
+    for ts, group in intervals.items():
+        if resolution == 1 and len(group) == 1:
+            point = dict(group[0])
+            if not with_hist:
+                point.pop('hist', None)
+            merged.append(point)
+            continue
+        responses = sum(point['rps'] for point in group)
+        hist = collections.Counter()
+        proto_code = collections.Counter()
+        net_code = collections.Counter()
+        for point in group:
+            hist.update(dict(zip(point['hist']['bins'], point['hist']['data'])))
+            proto_code.update(point['proto_code'])
+            net_code.update(point['net_code'])
+        bins = sorted(hist)
+        counts = [hist[bound] for bound in bins]
+        quantiles = sorted(
+            set(q for point in group for q in point['quantiles']), key=int)
+        planned = [
+            point['planned_rps'] for point in group
+            if point.get('planned_rps') is not None
+        ]
+        instances = [
+            point['instances'] for point in group
+            if point.get('instances') is not None
+        ]
+        point = {
+            'ts': ts,
+            'seconds': len(group),
+            'rps': float(responses) / len(group),
+            'planned_rps': float(sum(planned)) / len(planned)
+            if planned else None,
+            'instances': max(instances) if instances else None,
+            'mean': sum(
+                point['mean'] * point['rps'] for point in group
+                if point['mean'] is not None) / responses
+            if responses else None,
+            'max': max([
+                point['max'] for point in group if point['max'] is not None
+            ] or [None]),
+            'quantiles': dict(
+                (q, hist_quantile(bins, counts, sum(counts), int(q)))
+                for q in quantiles),
+            'proto_code': dict(proto_code),
+            'net_code': dict(net_code),
+        }
+        if with_hist:
+            point['hist'] = {'bins': bins, 'data': counts}
+        merged.append(point)
+    return merged
+
+
+def tar_header(name, size, mtime):
+    """Return tar header block(s) for a regular file"""
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    return info.tobuf(tarfile.GNU_FORMAT)
+
+
+def tar_padding(size):
+    """Return zero bytes completing the last block of a tar member"""
+    return b'\0' * (-size % TAR_BLOCK_SIZE)
+
+
+def read_archive_chunk(source, length, compressor=None):
+    """
+    Read length bytes of an archive member,
+    zero-padded if the file became shorter or source is None.
+    Returns the data compressed with compressor, if specified,
+    and whether it was padded.
+    """
+    data = source.read(length) if source is not None else b''
+    padded = len(data) < length
+    data += b'\0' * (length - len(data))
+    if compressor is not None:
+        data = compressor.compress(data)
+    return data, padded
+
+
+def choose_encoding(accept_encoding):
+    """
+    Pick the best supported content coding from Accept-Encoding value.
+    Returns None for identity.
+    """
+    offered = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        offered[name.strip().lower()] = quality
+    for encoding in ['zstd', 'gzip']:
+        if encoding == 'zstd' and zstd is None:
+            continue
+        if offered.get(encoding, offered.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+def make_compressor(encoding):
+    """Return streaming compressor object with compress() and flush()"""
+    if encoding == 'zstd':
+        return zstd.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def compress_chunk(source, compressor, copy_to=None):
+    """
+    Read and compress the next chunk of the source file.
+    Returns compressed data and EOF flag.
+    Compressed data is also written to copy_to, if specified.
+    """
+    chunk = source.read(TRANSFER_CHUNK_SIZE)
+    data = compressor.compress(chunk) if chunk else compressor.flush()
+    if copy_to is not None:
+        copy_to.write(data)
+    return data, not chunk
+
+
+class TokenBucket(object):
+    """
+    Byte budget refilled at a constant rate.
+    Reservations may overdraw it, the caller should wait
+    for the returned delay before spending the bytes.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.timestamp = time.time()
+
+    def reserve(self, amount):
+        """Take amount from the budget, return delay in seconds"""
+        now = time.time()
+        self.tokens = min(
+            self.rate, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+
+class GZipContentEncoding(tornado.web.GZipContentEncoding):
+    """
+    Applies gzip to responses except server-sent events:
+    events should reach the client as soon as they are flushed
+    """
+
+    def _compressible_type(self, ctype):
+        return ctype != 'text/event-stream' \
+            and super(GZipContentEncoding, self)._compressible_type(ctype)
 
 
 class APIHandler(tornado.web.RequestHandler):  # pylint: disable=R0904
@@ -37,6 +416,18 @@ class APIHandler(tornado.web.RequestHandler):  # pylint: disable=R0904
         server.read_status_updates()
         self.srv = server
 
+    def write(self, chunk):
+        if not isinstance(chunk, dict):
+            chunk = tornado.escape.utf8(chunk)
+            self.srv.metrics.count_response_bytes(
+                self.__class__.__name__, len(chunk))
+        super(APIHandler, self).write(chunk)
+
+    def on_finish(self):
+        self.srv.metrics.observe_request(
+            self.__class__.__name__, self.request.method, self.get_status(),
+            self.request.request_time())
+
     def reply_json(self, status_code, reply):
         """
         Reply with a json and a specified code
@@ -66,6 +457,7 @@ class ValidateConfgiHandler(APIHandler):  # pylint: disable=R0904
     Handles POST /validate
     """
 
+    @tornado.gen.coroutine
     def post(self):
         config = self.request.body
         try:
@@ -77,13 +469,18 @@ class ValidateConfgiHandler(APIHandler):  # pylint: disable=R0904
         except AssertionError as aexc:
             self.reply_reason(400, repr(aexc))
             return
-        _, errors, configinitial = TankConfig(
-            [load_core_base_cfg()] + load_local_base_cfgs() + [config],
-            with_dynamic_options=False
-        ).validate()
+
+        base_configs, base_signature = yield self.srv.run_in_io_pool(
+            self.srv.machine_defaults.get_with_signature)
+        key = (hashlib.sha256(self.request.body).hexdigest(), base_signature)
+        errors = self.srv.validation_cache.get(key)
+        if errors is None:
+            errors = yield tornado.ioloop.IOLoop.current().run_in_executor(
+                self.srv.validation_pool, validate_config, base_configs,
+                config)
+            self.srv.validation_cache.put(key, errors)
 
         self.reply_json(200, {'config': yaml.safe_dump(config), 'errors': errors})
-        return
 
 
 class RunHandler(APIHandler):  # pylint: disable=R0904
@@ -91,20 +488,46 @@ class RunHandler(APIHandler):  # pylint: disable=R0904
     Handles POST /run and get /run
     """
 
+    def heartbeat_argument(self):
+        """
+        Return (valid, heartbeat timeout or None if not given),
+        reply 400 if the timeout is invalid
+        """
+        try:
+            hb_timeout = self.get_argument('heartbeat', None)
+            hb_timeout = float(hb_timeout) if hb_timeout is not None else None
+            if hb_timeout is not None and hb_timeout <= 0:
+                raise ValueError(hb_timeout)
+        except ValueError:
+            self.reply_reason(
+                400, 'Heartbeat timeout should be a positive number.')
+            return False, None
+        return True, hb_timeout
+
     def post(self):
 
         offered_test_id = self.get_argument(
             'test', datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
         breakpoint = self.get_argument('break', 'finished')
-        hb_timeout = self.get_argument('heartbeat', None)
+        valid, hb_timeout = self.heartbeat_argument()
+        if not valid:
+            return
 
         config = self.request.body
 
-        # 503 if any running session exists
-        if self.srv.running_id is not None:
-            reply = {'reason': 'Another session is already running.'}
-            reply.update(self.srv.running_status)
-            self.reply_json(503, reply)
+        try:
+            priority = int(self.get_argument('priority', 0))
+        except ValueError:
+            self.reply_reason(400, 'Priority should be an integer.')
+            return
+
+        # 503 if the session can't be run or queued
+        if self.srv.busy_slots() >= self.srv.max_sessions \
+                and self.srv.queue_length() >= self.srv.session_queue_limit:
+            self.reply_json(503, {
+                'reason': 'Session queue is full.',
+                'running_sessions': self.srv.running_ids
+            })
             return
 
         # 400 if invalid breakpoint
@@ -123,25 +546,31 @@ class RunHandler(APIHandler):  # pylint: disable=R0904
             self.reply_reason(500, str(err))
             return
 
-        # Remember that such session exists
-        self.srv.set_session_status(
-            session_id, {'status': 'starting',
-                         'break': breakpoint})
-        # Post run command to manager queue
-        self.srv.cmd({
+        self.srv.submit_session(session_id, {
             'session': session_id,
             'cmd': 'run',
             'break': breakpoint,
             'config': config
-        })
+        }, priority, hb_timeout)
 
-        self.srv.heartbeat(session_id, hb_timeout)
-        self.reply_json(200, {'session': session_id})
+        reply = {'session': session_id}
+        if self.srv.is_queued(session_id):
+            reply.update(self.srv.status(session_id))
+        self.reply_json(200, reply)
 
+    @tornado.gen.coroutine
     def get(self):
         breakpoint = self.get_argument('break', 'finished')
         session_id = self.get_argument('session')
-        hb_timeout = self.get_argument('heartbeat', None)
+        valid, hb_timeout = self.heartbeat_argument()
+        if not valid:
+            return
+        try:
+            start_at = self.get_argument('start_at', None)
+            start_at = float(start_at) if start_at is not None else None
+        except ValueError:
+            self.reply_reason(400, 'start_at should be a unix timestamp.')
+            return
 
         self.set_header('Content-type', 'application/json')
 
@@ -158,12 +587,21 @@ class RunHandler(APIHandler):  # pylint: disable=R0904
 
         # 404 if no such session
         try:
-            status_dict = self.srv.status(session_id)
+            status_dict = yield self.srv.load_status(session_id)
         except KeyError:
             self.reply_reason(404, 'No session with this ID.')
             return
 
-        if session_id != self.srv.running_id:
+        if self.srv.is_queued(session_id):
+            if start_at is not None:
+                self.reply_reason(
+                    409, 'Can not schedule start of a queued session.')
+                return
+            self.srv.set_queued_break(session_id, breakpoint)
+            self.reply_reason(200, 'Will start the session with this break.')
+            return
+
+        if not self.srv.is_running(session_id):
             self.reply_reason(
                 418,
                 'I\'m a teapot! Can\'t set break for session that\'s not running!')
@@ -182,7 +620,10 @@ class RunHandler(APIHandler):  # pylint: disable=R0904
             return
 
         # Post run command to manager queue
-        self.srv.cmd({'session': session_id, 'cmd': 'run', 'break': breakpoint})
+        cmd = {'session': session_id, 'cmd': 'run', 'break': breakpoint}
+        if start_at is not None:
+            cmd['start_at'] = start_at
+        self.srv.cmd(cmd)
 
         self.srv.heartbeat(session_id, hb_timeout)
         self.reply_reason(200, 'Will try to set break before ' + breakpoint)
@@ -193,15 +634,20 @@ class StopHandler(APIHandler):  # pylint: disable=R0904
     Handles GET /stop
     """
 
+    @tornado.gen.coroutine
     def get(self):
         session_id = self.get_argument('session')
 
         try:
-            self.srv.status(session_id)
+            yield self.srv.load_status(session_id)
         except KeyError:
             self.reply_reason(404, 'No session with this ID.')
             return
-        if self.srv.running_id == session_id:
+        if self.srv.is_queued(session_id):
+            self.srv.cancel_queued(session_id)
+            self.reply_reason(200, 'Removed the session from the queue.')
+            return
+        if self.srv.is_running(session_id):
             self.srv.cmd({'cmd': 'stop', 'session': session_id})
             self.reply_reason(200, 'Will try to stop tank process.')
             return
@@ -215,42 +661,303 @@ class StatusHandler(APIHandler):  # pylint: disable=R0904
     Handle GET /status?
     """
 
+    @tornado.gen.coroutine
     def get(self):
         session_id = self.get_argument('session', default=None)
         if session_id:
             try:
-                status = self.srv.status(session_id)
+                status = yield self.srv.load_status(session_id)
             except KeyError:
                 self.reply_reason(404, 'No session with this ID.')
+                return
             self.srv.heartbeat(session_id)
             self.reply_json(200, status)
-        else:
-            self.reply_json(200, self.srv.all_sessions)
+            return
+
+        statuses = self.get_argument('status', None)
+        try:
+            since = self.get_argument('since', None)
+            since = float(since) if since is not None else None
+            until = self.get_argument('until', None)
+            until = float(until) if until is not None else None
+            limit = self.get_argument('limit', None)
+            limit = int(limit) if limit is not None else None
+            offset = int(self.get_argument('offset', 0))
+        except ValueError:
+            self.reply_reason(
+                400, 'since, until, limit and offset should be numbers.')
+            return
+        found, total = yield self.srv.run_in_io_pool(
+            functools.partial(
+                self.srv.find_sessions,
+                statuses=statuses.split(',') if statuses else None,
+                since=since,
+                until=until,
+                limit=limit,
+                offset=offset))
+        self.set_header('X-Total-Count', total)
+        self.reply_json(200, collections.OrderedDict(found))
+
+
+class TimingsHandler(APIHandler):  # pylint: disable=R0904
+    """
+    Handle GET /timings?
+    Aggregates stage and plugin durations of finished sessions
+    """
+
+    @tornado.gen.coroutine
+    def get(self):
+        statuses = self.get_argument('status', None)
+        try:
+            since = self.get_argument('since', None)
+            since = float(since) if since is not None else None
+            until = self.get_argument('until', None)
+            until = float(until) if until is not None else None
+            limit = int(self.get_argument('limit', TIMINGS_HISTORY_LIMIT))
+        except ValueError:
+            self.reply_reason(400, 'since, until and limit should be numbers.')
+            return
+        if limit < 1:
+            self.reply_reason(400, 'limit should be positive.')
+            return
+        statuses = statuses.split(',') if statuses else sessions.FINAL_STATUSES
+        if not set(statuses) <= set(sessions.FINAL_STATUSES):
+            self.reply_reason(400, 'Only finished sessions can be aggregated.')
+            return
+
+        found, _ = yield self.srv.run_in_io_pool(
+            functools.partial(
+                self.srv.find_sessions,
+                statuses=statuses,
+                since=since,
+                until=until,
+                limit=min(limit, TIMINGS_HISTORY_LIMIT_MAX)))
+        reply = yield self.srv.run_in_io_pool(
+            aggregate_timings, [status for _, status in found])
+        self.reply_json(200, reply)
+
+
+class StatusStreamHandler(APIHandler):  # pylint: disable=R0904
+    """
+    Handle GET /status/stream?
+    Long-polls until the session status version exceeds `since`,
+    or streams every new version as server-sent events
+    """
+
+    def initialize(self, server):  # pylint: disable=W0221
+        super(StatusStreamHandler, self).initialize(server)
+        self.disconnected = False  # pylint: disable=W0201
+
+    def on_connection_close(self):
+        self.disconnected = True  # pylint: disable=W0201
+        self.srv.notify_status_waiters()
+
+    @tornado.gen.coroutine
+    def versioned_status(self, session_id):
+        """
+        Return future of (version, status with version),
+        which can raise KeyError
+        """
+        status = yield self.srv.load_status(session_id)
+        version = self.srv.status_version(session_id)
+        reply = dict(status)
+        reply['version'] = version
+        raise tornado.gen.Return((version, reply))
+
+    @tornado.gen.coroutine
+    def get(self):
+        session_id = self.get_argument('session')
+        try:
+            since = int(self.get_argument('since', -1))
+            timeout = min(
+                float(self.get_argument('timeout', STATUS_WAIT_TIMEOUT)),
+                STATUS_WAIT_TIMEOUT_MAX)
+        except ValueError:
+            self.reply_reason(400, 'since and timeout should be numbers.')
+            return
+
+        try:
+            yield self.srv.load_status(session_id)
+        except KeyError:
+            self.reply_reason(404, 'No session with this ID.')
+            return
+        self.srv.heartbeat(session_id)
+
+        if 'text/event-stream' in self.request.headers.get('Accept', ''):
+            yield self.stream_events(session_id, since)
+            return
 
+        deadline = time.time() + timeout
+        while self.srv.status_version(session_id) <= since:
+            remaining = deadline - time.time()
+            if remaining <= 0 or self.disconnected:
+                break
+            yield self.srv.wait_status_change(remaining)
+        if not self.disconnected:
+            _, reply = yield self.versioned_status(session_id)
+            self.reply_json(200, reply)
+
+    @tornado.gen.coroutine
+    def stream_events(self, session_id, since):
+        """Send status versions as SSE until the session ends"""
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        try:
+            while not self.disconnected:
+                version, reply = yield self.versioned_status(session_id)
+                if version > since:
+                    since = version
+                    self.write('id: {}\ndata: {}\n\n'.format(
+                        version, json.dumps(reply)))
+                    yield self.flush()
+                    if reply.get('status') in ['success', 'failed']:
+                        break
+                else:
+                    yield self.srv.wait_status_change(STATUS_WAIT_TIMEOUT)
+                    # comment line keeps proxies from dropping the stream
+                    self.write(':\n\n')
+                    yield self.flush()
+                self.srv.heartbeat(session_id)
+        except tornado.iostream.StreamClosedError:
+            return
+        self.finish()
 
+
+@tornado.web.stream_request_body
 class UploadHandler(APIHandler):  # pylint: disable=R0904
     """
-    Handles POST /upload
+    Handles POST /upload and GET /upload
+    The request body is written to the session directory as it arrives
     """
 
-    def post(self):
+    def initialize(self, server):  # pylint: disable=W0221
+        super(UploadHandler, self).initialize(server)
+        # pylint: disable=W0201
+        self.upload_file = None
+        self.tmp_path = None
+        self.checksum = hashlib.sha256()
+        self.progress = None
+        self.pending_write = None
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        if self.request.method != 'POST':
+            return
         session_id = self.get_argument('session')
-        if session_id != self.srv.running_id:
+        if not self.srv.is_running(session_id):
             self.reply_reason(404, 'Specified session is not running')
             return
-
         filename = self.get_argument('filename')
-        contents = self.request.body
 
+        expected = self.request.headers.get('Content-Length')
+        expected = int(expected) if expected is not None else None
+        if expected is not None and expected > self.srv.upload_size_limit:
+            self.reply_json(
+                413, {
+                    'reason': 'File is too large',
+                    'limit': self.srv.upload_size_limit
+                })
+            return
+        self.request.connection.set_max_body_size(self.srv.upload_size_limit)
+
+        # pylint: disable=W0201
+        self.tmp_path = self.srv.session_file(
+            session_id, '{}.{}{}'.format(filename, uuid.uuid4(), TMP_SUFFIX))
+        self.upload_file = yield self.srv.run_in_io_pool(
+            open, self.tmp_path, 'wb')
+        self.progress = {'received': 0, 'expected': expected, 'done': False}
+        self.srv.set_upload_progress(session_id, filename, self.progress)
+
+    def write_chunk(self, upload_file, chunk):
+        """Write chunk to the file and update checksum"""
+        upload_file.write(chunk)
+        self.checksum.update(chunk)
+
+    @tornado.gen.coroutine
+    def data_received(self, chunk):
+        if self.upload_file is None:
+            return
+        self.pending_write = self.srv.run_in_io_pool(
+            self.write_chunk, self.upload_file, chunk)
+        yield self.pending_write
+        self.progress['received'] += len(chunk)
+
+    def on_connection_close(self):
+        self.discard_upload()
+
+    def on_finish(self):
+        self.discard_upload()
+        super(UploadHandler, self).on_finish()
+
+    @staticmethod
+    def remove_upload(upload_file, tmp_path):
+        upload_file.close()
+        os.remove(tmp_path)
+
+    @tornado.gen.coroutine
+    def discard_upload(self):
+        """
+        Remove unfinished temporary file and forget its progress.
+        A chunk may still be being written in the io pool, wait for it.
+        """
+        upload_file = self.upload_file
+        if upload_file is None:
+            return
+        self.upload_file = None  # pylint: disable=W0201
+        self.srv.drop_upload_progress(
+            self.get_argument('session'), self.get_argument('filename'),
+            self.progress)
+        if self.pending_write is not None:
+            try:
+                yield self.pending_write
+            except Exception:  # pylint: disable=W0703
+                pass
+        try:
+            yield self.srv.run_in_io_pool(
+                self.remove_upload, upload_file, self.tmp_path)
+        except (IOError, OSError):
+            _log.warning('Failed to remove %s', self.tmp_path, exc_info=True)
+
+    @tornado.gen.coroutine
+    def post(self):
+        session_id = self.get_argument('session')
+        filename = self.get_argument('filename')
         filepath = self.srv.session_file(session_id, filename)
-        tmp_path = filepath + str(uuid.uuid4())
 
-        with open(tmp_path, 'wb') as upload_file:
-            upload_file.write(contents)
-        os.rename(tmp_path, filepath)
+        expected_sha256 = self.get_argument('sha256', None)
+        sha256 = self.checksum.hexdigest()
+        if expected_sha256 is not None and expected_sha256.lower() != sha256:
+            self.reply_json(
+                400, {
+                    'reason': 'Checksum mismatch',
+                    'sha256': sha256
+                })
+            return
+
+        upload_file = self.upload_file
+        self.upload_file = None  # pylint: disable=W0201
+        yield self.srv.run_in_io_pool(upload_file.close)
+        yield self.srv.run_in_io_pool(os.rename, self.tmp_path, filepath)
+        self.progress['done'] = True
+        self.progress['sha256'] = sha256
 
         self.srv.heartbeat(session_id)
-        self.reply_reason(200, 'File uploaded')
+        self.reply_json(
+            200, {
+                'reason': 'File uploaded',
+                'size': self.progress['received'],
+                'sha256': sha256
+            })
+
+    def get(self):
+        session_id = self.get_argument('session')
+        filename = self.get_argument('filename')
+        try:
+            progress = self.srv.upload_progress(session_id, filename)
+        except KeyError:
+            self.reply_reason(404, 'No such upload')
+            return
+        self.reply_json(200, progress)
 
 
 class ArtifactHandler(APIHandler):  # pylint: disable=R0904
@@ -258,11 +965,17 @@ class ArtifactHandler(APIHandler):  # pylint: disable=R0904
     Handle GET /atrifact?
     """
 
+    @tornado.gen.coroutine
     def get(self):
         session_id = self.get_argument('session')
 
         filename = self.get_argument('filename', None)
-        maxsize = self.get_argument('maxsize', None)
+        try:
+            maxsize = self.get_argument('maxsize', None)
+            maxsize = int(maxsize) if maxsize is not None else None
+        except ValueError:
+            self.reply_reason(400, 'maxsize should be a number.')
+            return
 
         # look for test directory
         if not os.path.exists(self.srv.session_dir(session_id)):
@@ -276,19 +989,35 @@ class ArtifactHandler(APIHandler):  # pylint: disable=R0904
             return
 
         if not filename:
-            basepath = self.srv.session_dir(session_id)
-            onlyfiles = [
-                f for f in os.listdir(basepath)
-                if os.path.isfile(os.path.join(basepath, f))
-            ]
-            self.reply_json(200, onlyfiles)
+            manifest, _ = yield self.srv.artifact_manifest(session_id)
+            self.reply_json(200, [entry['name'] for entry in manifest])
             return
 
         filepath = self.srv.session_file(session_id, filename)
         if not os.path.exists(filepath):
             self.reply_reason(404, 'No such file in test artifacts')
             return
-        file_size = os.stat(filepath).st_size
+        file_stat = os.stat(filepath)
+        file_size = file_stat.st_size
+
+        range_header = self.request.headers.get('Range')
+        encoding = None
+        if not range_header and file_size >= COMPRESSION_MIN_SIZE:
+            encoding = choose_encoding(
+                self.request.headers.get('Accept-Encoding', ''))
+        version = '{:x}-{:x}'.format(
+            file_size, int(file_stat.st_mtime * 1000000))
+        etag = '"{}"'.format(
+            version if encoding is None else version + '-' + encoding)
+        self.set_header('Etag', etag)
+        self.set_header(
+            'Last-Modified',
+            datetime.datetime.utcfromtimestamp(int(file_stat.st_mtime)))
+        self.set_header('Accept-Ranges', 'bytes')
+        if self.is_not_modified(file_stat.st_mtime):
+            self.set_status(304)
+            self.finish()
+            return
 
         if maxsize is not None and file_size > maxsize:
             self.reply_json(
@@ -299,33 +1028,531 @@ class ArtifactHandler(APIHandler):  # pylint: disable=R0904
                 })
             return
 
-        if file_size > TRANSFER_SIZE_LIMIT:
-            try:
-                cur_stage = self.srv.running_status['current_stage']
-            except KeyError:
-                pass
+        if file_size > TRANSFER_SIZE_LIMIT and self.srv.is_load_running():
+            self.reply_json(
+                503, {
+                    'reason': 'File is too large and a session is running',
+                    'running_sessions': self.srv.running_ids,
+                    'filesize': file_size,
+                    'limit': TRANSFER_SIZE_LIMIT
+                })
+            return
+
+        ranges = None
+        if range_header and self.is_range_allowed(etag, file_stat.st_mtime):
+            ranges = parse_byte_ranges(range_header, file_size)
+        if ranges == []:
+            self.set_header('Content-Range', 'bytes */{}'.format(file_size))
+            self.reply_reason(416, 'Requested range not satisfiable')
+            return
+
+        try:
+            if encoding is not None:
+                self.set_header('Content-type', 'application/octet-stream')
+                self.set_header('Content-Encoding', encoding)
+                cache_path = None
+                if not self.srv.is_running(session_id):
+                    cache_path = os.path.join(
+                        self.srv.session_dir(session_id),
+                        COMPRESSED_CACHE_DIR, filename,
+                        '{}.{}'.format(version, encoding))
+                yield self.send_compressed(filepath, encoding, cache_path)
+            elif not ranges:
+                self.set_header('Content-type', 'application/octet-stream')
+                self.set_header('Content-Length', file_size)
+                yield self.send_file(filepath, 0, file_size)
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self.set_status(206)
+                self.set_header('Content-type', 'application/octet-stream')
+                self.set_header('Content-Length', end - start)
+                self.set_header(
+                    'Content-Range',
+                    'bytes {}-{}/{}'.format(start, end - 1, file_size))
+                yield self.send_file(filepath, start, end)
             else:
-                if common.is_a_earlier_than_b(cur_stage, 'postprocess'):
-                    self.reply_json(
-                        503, {
-                            'reason':
-                            'File is too large and a session is running',
-                            'running_session': self.srv.running_id,
-                            'filesize': file_size,
-                            'limit': TRANSFER_SIZE_LIMIT
-                        })
-                    return
-        self.set_header('Content-type', 'application/octet-stream')
+                yield self.send_multipart(filepath, ranges, file_size)
+        except tornado.iostream.StreamClosedError:
+            return
+        self.finish()
+        self.srv.heartbeat(session_id)
+
+    def is_not_modified(self, mtime):
+        """Check If-None-Match, or If-Modified-Since if it is absent"""
+        if 'If-None-Match' in self.request.headers:
+            return self.check_etag_header()
+        since = self.request.headers.get('If-Modified-Since')
+        if since:
+            parsed = email.utils.parsedate_tz(since)
+            return parsed is not None \
+                and int(mtime) <= email.utils.mktime_tz(parsed)
+        return False
+
+    def is_range_allowed(self, etag, mtime):
+        """Check that If-Range, if present, matches the file"""
+        if_range = self.request.headers.get('If-Range')
+        if not if_range:
+            return True
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            return if_range == etag
+        parsed = email.utils.parsedate_tz(if_range)
+        return parsed is not None \
+            and int(mtime) == email.utils.mktime_tz(parsed)
+
+    @tornado.gen.coroutine
+    def send_compressed(self, filepath, encoding, cache_path):
+        """
+        Send compressed file.
+        Use cached compressed variant if it exists,
+        otherwise compress on the fly and store the result to cache_path.
+        No caching is done if cache_path is None.
+        """
+        if cache_path is not None and os.path.exists(cache_path):
+            cached_size = os.stat(cache_path).st_size
+            self.set_header('Content-Length', cached_size)
+            yield self.send_file(cache_path, 0, cached_size)
+            return
+
+        cache_file = None
+        if cache_path is not None:
+            cache_dir = os.path.dirname(cache_path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = cache_path + str(uuid.uuid4())
+            cache_file = open(tmp_path, 'wb')
+
+        compressor = make_compressor(encoding)
+        try:
+            with open(filepath, 'rb') as artifact_file:
+                eof = False
+                while not eof:
+                    data, eof = yield self.srv.run_in_io_pool(
+                        compress_chunk, artifact_file, compressor, cache_file)
+                    if data:
+                        self.write(data)
+                        yield self.flush()
+        except BaseException:
+            if cache_file is not None:
+                cache_file.close()
+                os.remove(tmp_path)
+            raise
+
+        if cache_file is not None:
+            cache_file.close()
+            # Drop the variants of older file versions
+            for name in os.listdir(cache_dir):
+                if not name.endswith('.' + encoding):
+                    continue
+                try:
+                    os.remove(os.path.join(cache_dir, name))
+                except OSError:
+                    pass
+            os.rename(tmp_path, cache_path)
+
+    @tornado.gen.coroutine
+    def send_multipart(self, filepath, ranges, file_size):
+        """Send several ranges as multipart/byteranges"""
+        boundary = uuid.uuid4().hex
+        part_headers = [
+            '--{}\r\nContent-Type: application/octet-stream\r\n'
+            'Content-Range: bytes {}-{}/{}\r\n\r\n'.format(
+                boundary, start, end - 1, file_size).encode('ascii')
+            for start, end in ranges
+        ]
+        closing = '--{}--\r\n'.format(boundary).encode('ascii')
+        self.set_status(206)
+        self.set_header(
+            'Content-type',
+            'multipart/byteranges; boundary={}'.format(boundary))
+        parts_length = sum(
+            len(h) + end - start + 2
+            for h, (start, end) in zip(part_headers, ranges))
+        self.set_header('Content-Length', parts_length + len(closing))
+        for part_header, (start, end) in zip(part_headers, ranges):
+            self.write(part_header)
+            yield self.send_file(filepath, start, end)
+            self.write(b'\r\n')
+        self.write(closing)
+
+    @tornado.gen.coroutine
+    def send_file(self, filepath, start, end):
+        """
+        Read [start, end) bytes of the file in the IO thread pool
+        and send them chunk by chunk,
+        waiting for every chunk to be flushed before reading the next one
+        """
         with open(filepath, 'rb') as artifact_file:
-            while True:
-                data = artifact_file.read(TRANSFER_SIZE_LIMIT)
+            artifact_file.seek(start)
+            left = end - start
+            while left > 0:
+                data = yield self.srv.run_in_io_pool(
+                    artifact_file.read, min(left, TRANSFER_CHUNK_SIZE))
                 if not data:
                     break
+                left -= len(data)
                 self.write(data)
-                self.flush()
+                yield self.flush()
+
+
+class ArtifactManifestHandler(APIHandler):  # pylint: disable=R0904
+    """
+    Handle GET /artifact/manifest?
+    """
+
+    @tornado.gen.coroutine
+    def get(self):
+        session_id = self.get_argument('session')
+        pattern = self.get_argument('pattern', '*')
+        hash_name = self.get_argument('hash', None)
+        try:
+            limit = self.get_argument('limit', None)
+            limit = int(limit) if limit is not None else None
+            offset = int(self.get_argument('offset', 0))
+        except ValueError:
+            self.reply_reason(400, 'limit and offset should be numbers.')
+            return
+        if hash_name not in [None, 'sha256']:
+            self.reply_reason(400, 'Only sha256 hash is supported.')
+            return
+
+        if not os.path.exists(self.srv.session_dir(session_id)):
+            self.reply_reason(404, 'No session with this ID found')
+            return
+        if self.srv.is_empty_session(session_id):
+            self.reply_reason(404, 'Test was not performed, no artifacts.')
+            return
+
+        manifest, frozen = yield self.srv.artifact_manifest(session_id)
+        matched = [
+            entry for entry in manifest
+            if fnmatch.fnmatch(entry['name'], pattern)
+        ]
+        page = matched[offset:None if limit is None else offset + limit]
+        if hash_name is not None:
+            for entry in page:
+                if 'sha256' not in entry:
+                    entry['sha256'] = yield self.srv.run_in_io_pool(
+                        file_sha256,
+                        self.srv.session_file(session_id, entry['name']))
+
+        self.reply_json(
+            200, {
+                'files': page,
+                'total': len(matched),
+                'frozen': frozen
+            })
+
+
+class ArtifactArchiveHandler(APIHandler):  # pylint: disable=R0904
+    """
+    Handle GET /artifact/archive?
+    Streams a tar archive of session artifacts built on the fly
+    """
+
+    @tornado.gen.coroutine
+    def get(self):
+        session_id = self.get_argument('session')
+        pattern = self.get_argument('pattern', '*')
+        compression = self.get_argument('compression', None)
+        if compression not in ARCHIVE_TYPES \
+                or (compression == 'zstd' and zstd is None):
+            self.reply_json(
+                400, {
+                    'reason': 'Unsupported compression.',
+                    'hint': {
+                        'compression': [
+                            name for name in ARCHIVE_TYPES
+                            if name and (name != 'zstd' or zstd is not None)
+                        ]
+                    }
+                })
+            return
+
+        if not os.path.exists(self.srv.session_dir(session_id)):
+            self.reply_reason(404, 'No session with this ID found')
+            return
+        if self.srv.is_empty_session(session_id):
+            self.reply_reason(404, 'Test was not performed, no artifacts.')
+            return
+
+        manifest, _ = yield self.srv.artifact_manifest(session_id)
+        members = [
+            (entry, tar_header(entry['name'], entry['size'], entry['mtime']))
+            for entry in manifest if fnmatch.fnmatch(entry['name'], pattern)
+        ]
+        total_size = sum(entry['size'] for entry, _ in members)
+        if total_size > TRANSFER_SIZE_LIMIT and self.srv.is_load_running():
+            self.reply_json(
+                503, {
+                    'reason': 'Archive is too large and a session is running',
+                    'running_sessions': self.srv.running_ids,
+                    'filesize': total_size,
+                    'limit': TRANSFER_SIZE_LIMIT
+                })
+            return
+
+        content_type, extension = ARCHIVE_TYPES[compression]
+        self.set_header('Content-type', content_type)
+        self.set_header(
+            'Content-Disposition',
+            'attachment; filename="{}{}"'.format(session_id, extension))
+        compressor = None
+        if compression is None:
+            self.set_header(
+                'Content-Length',
+                sum(len(header) + entry['size'] + len(tar_padding(entry['size']))
+                    for entry, header in members) + len(TAR_END))
+        else:
+            compressor = make_compressor(compression)
+
+        try:
+            for entry, header in members:
+                yield self.send_data(header, compressor)
+                yield self.send_member(
+                    self.srv.session_file(session_id, entry['name']),
+                    entry['size'], compressor)
+                yield self.send_data(tar_padding(entry['size']), compressor)
+            yield self.send_data(TAR_END, compressor)
+            if compressor is not None:
+                self.write(compressor.flush())
+        except tornado.iostream.StreamClosedError:
+            return
         self.finish()
         self.srv.heartbeat(session_id)
 
+    def send_data(self, data, compressor):
+        """Send small piece of data, compressed if required"""
+        if compressor is not None:
+            data = compressor.compress(data)
+        if data:
+            self.write(data)
+        return self.flush()
+
+    @tornado.gen.coroutine
+    def send_member(self, filepath, size, compressor):
+        """
+        Send exactly size bytes of the file, reading it in IO pool.
+        The size is already sent in the header, so a file that was removed
+        or became shorter is padded with zeros to keep the archive valid.
+        """
+        try:
+            member_file = yield self.srv.run_in_io_pool(open, filepath, 'rb')
+        except (IOError, OSError) as exc:
+            _log.warning('Archive member %s is gone: %s', filepath, exc)
+            member_file = None
+        truncated = False
+        try:
+            left = size
+            while left > 0:
+                length = min(left, TRANSFER_CHUNK_SIZE)
+                data, padded = yield self.srv.run_in_io_pool(
+                    read_archive_chunk, member_file, length, compressor)
+                left -= length
+                if padded and member_file is not None and not truncated:
+                    truncated = True
+                    _log.warning(
+                        'Archive member %s became shorter, padded with zeros',
+                        filepath)
+                if data:
+                    self.write(data)
+                    yield self.flush()
+        finally:
+            if member_file is not None:
+                member_file.close()
+
+
+class ArtifactTailHandler(APIHandler):  # pylint: disable=R0904
+    """
+    Handle GET /artifact/tail?
+    Sends the bytes of a growing artifact written after the given offset
+    """
+
+    def initialize(self, server):  # pylint: disable=W0221
+        super(ArtifactTailHandler, self).initialize(server)
+        self.disconnected = False  # pylint: disable=W0201
+
+    def on_connection_close(self):
+        self.disconnected = True  # pylint: disable=W0201
+        self.srv.notify_tank_activity()
+
+    @tornado.gen.coroutine
+    def get(self):
+        session_id = self.get_argument('session')
+        filename = self.get_argument('filename')
+        try:
+            offset = int(self.get_argument('offset', 0))
+            limit = min(
+                int(self.get_argument('limit', TAIL_SIZE_LIMIT)),
+                TAIL_SIZE_LIMIT)
+            timeout = min(
+                float(self.get_argument('timeout', 0)),
+                STATUS_WAIT_TIMEOUT_MAX)
+        except ValueError:
+            self.reply_reason(400, 'offset, limit and timeout should be numbers.')
+            return
+        if offset < 0 or limit <= 0:
+            self.reply_reason(400, 'offset should not be negative and limit should be positive.')
+            return
+
+        if not os.path.exists(self.srv.session_dir(session_id)):
+            self.reply_reason(404, 'No session with this ID found')
+            return
+        if self.srv.is_empty_session(session_id):
+            self.reply_reason(404, 'Test was not performed, no artifacts.')
+            return
+        filepath = self.srv.session_file(session_id, filename)
+        if not os.path.isfile(filepath):
+            self.reply_reason(404, 'No such file in test artifacts')
+            return
+
+        # Wait for new data if asked to
+        deadline = time.time() + timeout
+        if timeout > 0:
+            try:
+                yield self.srv.load_status(session_id)
+            except KeyError:
+                pass
+        file_size = yield self.srv.run_in_io_pool(os.path.getsize, filepath)
+        while file_size <= offset:
+            remaining = deadline - time.time()
+            if remaining <= 0 or self.srv.is_finished_session(session_id):
+                break
+            yield self.srv.wait_tank_activity(
+                min(remaining, TAIL_RECHECK_INTERVAL))
+            if self.disconnected:
+                return
+            file_size = yield self.srv.run_in_io_pool(
+                os.path.getsize, filepath)
+
+        if offset > file_size:
+            self.reply_json(
+                416, {
+                    'reason': 'Offset is beyond the end of file',
+                    'filesize': file_size
+                })
+            return
+
+        length = min(file_size - offset, limit)
+        if self.srv.is_load_running():
+            delay = self.srv.tail_budget.reserve(length)
+            if delay:
+                yield tornado.gen.sleep(delay)
+        data = yield self.srv.run_in_io_pool(
+            read_file_range, filepath, offset, length)
+
+        self.set_header('Content-type', 'application/octet-stream')
+        self.set_header('X-Offset', offset + len(data))
+        self.set_header('X-File-Size', file_size)
+        self.finish(data)
+        self.srv.heartbeat(session_id)
+
+
+class LiveMetricsHandler(APIHandler):  # pylint: disable=R0904
+    """
+    Handle GET /live_metrics?
+    Per-second load metrics of recent sessions, optionally downsampled
+    """
+
+    @tornado.gen.coroutine
+    def get(self):
+        session_id = self.get_argument('session')
+        try:
+            since = self.get_argument('since', None)
+            since = float(since) if since is not None else None
+            resolution = int(self.get_argument('resolution', 1))
+        except ValueError:
+            self.reply_reason(400, 'since and resolution should be numbers.')
+            return
+        if resolution < 1:
+            self.reply_reason(400, 'resolution should be positive.')
+            return
+        with_hist = self.get_argument('hist', '0') == '1'
+
+        try:
+            yield self.srv.load_status(session_id)
+        except KeyError:
+            self.reply_reason(404, 'No session with this ID.')
+            return
+        points = self.srv.live_metrics(session_id)
+        if points is None:
+            self.reply_reason(404, 'No load metrics for this session.')
+            return
+        if since is not None:
+            points = [point for point in points if point['ts'] > since]
+        self.reply_json(200, {
+            'resolution': resolution,
+            'points': downsample_live_metrics(points, resolution, with_hist)
+        })
+
+
+class LatencyHandler(APIHandler):  # pylint: disable=R0904
+    """
+    Handle GET /latency?
+    Response time quantiles of one or several finished sessions,
+    computed from their merged latency histograms
+    """
+
+    @tornado.gen.coroutine
+    def get(self):
+        session_ids = self.get_arguments('session')
+        if not session_ids:
+            self.reply_reason(400, 'Specify at least one session.')
+            return
+        try:
+            resolution = self.get_argument('resolution', None)
+            resolution = int(resolution) if resolution is not None else None
+            quantiles = self.get_argument('quantiles', None)
+            quantiles = [float(q) for q in quantiles.split(',')] \
+                if quantiles else latency.DEFAULT_QUANTILES
+        except ValueError:
+            self.reply_reason(400, 'resolution and quantiles should be numbers.')
+            return
+        if resolution is not None and resolution < 1:
+            self.reply_reason(400, 'resolution should be positive.')
+            return
+        if not all(0 <= q <= 100 for q in quantiles):
+            self.reply_reason(400, 'quantiles should be between 0 and 100.')
+            return
+
+        filenames = []
+        for session_id in session_ids:
+            if not os.path.exists(self.srv.session_dir(session_id)):
+                self.reply_reason(404, 'No session with this ID found')
+                return
+            filename = self.srv.session_file(session_id, latency.ARTIFACT_NAME)
+            if not os.path.exists(filename):
+                self.reply_reason(
+                    404, 'No latency histograms for this session.')
+                return
+            filenames.append(filename)
+        try:
+            merged = yield self.srv.run_in_io_pool(
+                latency.merge_files, filenames)
+        except ValueError as exc:
+            self.reply_reason(409, str(exc))
+            return
+        reply = yield self.srv.run_in_io_pool(
+            merged.summary, quantiles, resolution)
+        reply['sessions'] = session_ids
+        self.reply_json(200, reply)
+
+
+class MetricsHandler(APIHandler):  # pylint: disable=R0904
+    """
+    Handle GET /metrics
+    Replies in OpenMetrics format if the client accepts it,
+    in Prometheus text format otherwise
+    """
+
+    def get(self):
+        openmetrics = 'application/openmetrics-text' in self.request.headers.get(
+            'Accept', '')
+        self.set_header(
+            'Content-Type', metrics.OPENMETRICS_CONTENT_TYPE
+            if openmetrics else metrics.PROMETHEUS_CONTENT_TYPE)
+        self.finish(
+            self.srv.metrics.render(self.srv.metric_gauges(), openmetrics))
+
 
 class StaticHandler(tornado.web.RequestHandler):  # pylint: disable=R0904
     """
@@ -342,14 +1569,46 @@ class StaticHandler(tornado.web.RequestHandler):  # pylint: disable=R0904
 class ApiServer(object):
     """ API server class"""
 
-    def __init__(self, in_queue, out_queue, working_dir, debug=False):
+    def __init__(
+            self, in_queue, out_queue, working_dir, debug=False,
+            upload_size_limit=None, max_sessions=1, session_queue_limit=None,
+            configs_location='/etc'):
         self._in_queue = in_queue
         self._out_queue = out_queue
         self._working_dir = working_dir
-        self._running_id = None
+        self.upload_size_limit = upload_size_limit or UPLOAD_SIZE_LIMIT
+        self.max_sessions = max_sessions
+        self.session_queue_limit = SESSION_QUEUE_LIMIT \
+            if session_queue_limit is None else session_queue_limit
+        self._running_ids = []
         self._sessions = {}
-        self._hb_deadline = None
-        self._hb_timeout = DEFAULT_HEARTBEAT_TIMEOUT
+        self._registry = sessions.SessionRegistry(working_dir)
+        self._registry.fail_unfinished('API server was restarted')
+        # One writer thread keeps status updates of a session in order
+        self._registry_pool = concurrent.futures.ThreadPoolExecutor(1)
+        # (status, version) of recently finished and looked up sessions
+        self._finished = common.LRUCache(FINISHED_STATUS_CACHE_SIZE)
+        self._uploads = {}
+        self._manifests = common.LRUCache(MANIFEST_CACHE_SIZE)
+        self._versions = {}
+        self._status_changed = tornado.locks.Condition()
+        self._tank_activity = tornado.locks.Condition()
+        self._io_pool = concurrent.futures.ThreadPoolExecutor(FILE_IO_THREADS)
+        self.tail_budget = TokenBucket(TAIL_RATE_LIMIT)
+        self.validation_pool = concurrent.futures.ThreadPoolExecutor(
+            VALIDATION_THREADS)
+        self.validation_cache = common.LRUCache(VALIDATION_CACHE_SIZE)
+        self.machine_defaults = worker.MachineDefaults(configs_location)
+        self._hb_timeouts = {}
+        self._hb_deadlines = {}
+        self._hb_timers = {}
+        self._queue = []
+        self._queued = {}
+        self._queue_counter = itertools.count()
+        self._started_at = {}
+        self._durations = collections.deque(maxlen=DURATION_HISTORY)
+        self.metrics = metrics.Metrics()
+        self._live_metrics = common.LRUCache(LIVE_METRICS_SESSIONS)
 
         handler_params = dict(server=self)
 
@@ -358,13 +1617,22 @@ class ApiServer(object):
             (r'/run', RunHandler, handler_params),
             (r'/stop', StopHandler, handler_params),
             (r'/status', StatusHandler, handler_params),
+            (r'/status/stream', StatusStreamHandler, handler_params),
+            (r'/timings', TimingsHandler, handler_params),
+            (r'/metrics', MetricsHandler, handler_params),
+            (r'/live_metrics', LiveMetricsHandler, handler_params),
+            (r'/latency', LatencyHandler, handler_params),
             (r'/artifact', ArtifactHandler, handler_params),
+            (r'/artifact/tail', ArtifactTailHandler, handler_params),
+            (r'/artifact/manifest', ArtifactManifestHandler, handler_params),
+            (r'/artifact/archive', ArtifactArchiveHandler, handler_params),
             (r'/upload', UploadHandler, handler_params),
             (r'/manager\.html$', StaticHandler, dict(template='manager.jade'))
         ]
 
         self.app = tornado.web.Application(
             handlers,
+            transforms=[GZipContentEncoding],
             template_path=os.path.join(os.path.dirname(__file__), 'templates'),
             static_path=os.path.join(os.path.dirname(__file__), 'static'),
             debug=debug, )
@@ -374,46 +1642,276 @@ class ApiServer(object):
         try:
             while True:
                 message = self._in_queue.get_nowait()
+                if 'manager_stats' in message:
+                    self.metrics.manager_stats = message['manager_stats']
+                    continue
+                if 'live_metrics' in message:
+                    self.add_live_metrics(
+                        message['session'], message['live_metrics'])
+                    continue
+                reported_at = message.get('reported_at')
+                self.metrics.observe_status_message(
+                    message.get('status'), time.time() - reported_at
+                    if reported_at is not None else None)
                 session_id = message.get('session')
                 del message['session']
                 self.set_session_status(session_id, message)
         except multiprocessing.queues.Empty:
             pass
+        self.start_queued_sessions()
 
-    def check(self):
-        """Read status messages from manager and check heartbeat"""
-        self.read_status_updates()
+    def set_session_status(self, session_id, new_status):
+        """Remember session status and update running sessions"""
+
+        if session_id in self._started_at \
+                and common.has_released_lock(new_status):
+            self._durations.append(
+                time.time() - self._started_at.pop(session_id))
+
+        if new_status['status'] in ['success', 'failed']:
+            if session_id in self._running_ids:
+                self._running_ids.remove(session_id)
+            self._uploads.pop(session_id, None)
+            self._sessions.pop(session_id, None)
+            self._stop_heartbeat(session_id)
+            self._started_at.pop(session_id, None)
+            self._finished.put(
+                session_id,
+                (new_status, self._versions.pop(session_id, 0) + 1))
+        else:
+            if new_status['status'] != 'queued' \
+                    and session_id not in self._running_ids:
+                self._running_ids.append(session_id)
+            self._sessions[session_id] = new_status
+            self._versions[session_id] = self._versions.get(session_id, 0) + 1
 
-        if self._running_id and self._hb_deadline is not None\
-                and time.time() > self._hb_deadline:
+        self._save_status(session_id, new_status)
+        self.notify_status_waiters()
 
-            self.cmd({
-                'cmd': 'run',
-                'session': self._running_id,
-                'break': 'finished'
+    def _save_status(self, session_id, status):
+        """
+        Store the status in the registry in the writer thread.
+        Meanwhile status() takes it from memory.
+        """
+        status = dict(status)
+
+        def on_saved(future):
+            if future.exception() is not None:
+                _log.error(
+                    'Failed to store status of session %s: %s', session_id,
+                    future.exception())
+
+        tornado.ioloop.IOLoop.current().add_future(
+            tornado.ioloop.IOLoop.current().run_in_executor(
+                self._registry_pool, self._registry.put, session_id, status),
+            on_saved)
+
+    def submit_session(self, session_id, command, priority, hb_timeout):
+        """
+        Queue run command of a new session.
+        Sessions with higher priority are started first,
+        sessions with equal priority are started in order of submission.
+        """
+        heapq.heappush(
+            self._queue, (-priority, next(self._queue_counter), session_id))
+        self._queued[session_id] = (command, hb_timeout)
+        self.set_session_status(
+            session_id, {
+                'status': 'queued',
+                'break': command['break'],
+                'priority': priority,
+                'queued_at': time.time()
             })
-            self.cmd({'cmd': 'stop', 'session': self._running_id})
+        self.start_queued_sessions()
+
+    def start_queued_sessions(self):
+        """Start queued sessions while there are free session slots"""
+        started = False
+        while self._queue and self.busy_slots() < self.max_sessions:
+            _, _, session_id = heapq.heappop(self._queue)
+            if session_id not in self._queued:
+                # Cancelled
+                continue
+            started = True
+            command, hb_timeout = self._queued.pop(session_id)
+            command['requested_at'] = time.time()
+            # Remember that such session exists
+            self.set_session_status(
+                session_id, {'status': 'starting',
+                             'break': command['break']})
+            self._started_at[session_id] = command['requested_at']
+            # Post run command to manager queue
+            self.cmd(command)
+            self.heartbeat(session_id, hb_timeout)
+        if started and self._queued:
+            # Positions of the sessions left in the queue have changed
+            for session_id in self._queued:
+                self._versions[session_id] += 1
+            self.notify_status_waiters()
+
+    def cancel_queued(self, session_id):
+        """Remove session from the queue and mark it as failed"""
+        del self._queued[session_id]
+        status = dict(self._sessions[session_id])
+        status.update({
+            'status': 'failed',
+            'reason': 'Cancelled while queued'
+        })
+        self.set_session_status(session_id, status)
+
+    def set_queued_break(self, session_id, breakpoint):
+        """Set the break the queued session will be started with"""
+        self._queued[session_id][0]['break'] = breakpoint
+        self._sessions[session_id]['break'] = breakpoint
+        self._save_status(session_id, self._sessions[session_id])
+        self._versions[session_id] += 1
+        self.notify_status_waiters()
+
+    def is_queued(self, session_id):
+        """Return true if the session waits in the queue"""
+        return session_id in self._queued
+
+    def queue_length(self):
+        """Return number of queued sessions"""
+        return len(self._queued)
+
+    def busy_slots(self):
+        """Return number of running sessions that have not released the lock"""
+        return sum(
+            1 for session_id in self._running_ids
+            if not common.has_released_lock(self._sessions[session_id]))
+
+    def _queue_estimates(self):
+        """
+        Return dict of (position, estimated start time) for queued sessions.
+        Start time is estimated from durations of recent sessions
+        and is None until some session has finished.
+        """
+        order = [
+            entry[2] for entry in sorted(self._queue)
+            if entry[2] in self._queued
+        ]
+        if not self._durations:
+            return dict(
+                (session_id, (pos, None))
+                for pos, session_id in enumerate(order))
+        duration = sum(self._durations) / len(self._durations)
+        now = time.time()
+        slots = [
+            max(now, self._started_at.get(session_id, now) + duration)
+            for session_id in self._running_ids
+            if not common.has_released_lock(self._sessions[session_id])
+        ]
+        slots.extend([now] * (self.max_sessions - len(slots)))
+        heapq.heapify(slots)
+        estimates = {}
+        for pos, session_id in enumerate(order):
+            start = heapq.heappop(slots)
+            estimates[session_id] = (pos, start)
+            heapq.heappush(slots, start + duration)
+        return estimates
+
+    def add_live_metrics(self, session_id, point):
+        """Remember per-second load metrics of the session"""
+        points = self._live_metrics.get(session_id)
+        if points is None:
+            points = collections.deque(maxlen=LIVE_METRICS_SECONDS)
+            self._live_metrics.put(session_id, points)
+        points.append(point)
+        self._tank_activity.notify_all()
+
+    def live_metrics(self, session_id):
+        """Return list of per-second load metrics or None"""
+        points = self._live_metrics.get(session_id)
+        return list(points) if points is not None else None
+
+    def notify_status_waiters(self):
+        """Wake up all requests waiting for a status change"""
+        self._status_changed.notify_all()
+        self._tank_activity.notify_all()
+
+    def wait_status_change(self, timeout):
+        """Return future resolved on the next status change or timeout"""
+        return self._status_changed.wait(
+            timeout=datetime.timedelta(seconds=timeout))
+
+    def notify_tank_activity(self):
+        """Wake up all requests waiting for artifacts to grow"""
+        self._tank_activity.notify_all()
+
+    def wait_tank_activity(self, timeout):
+        """
+        Return future resolved on the next status change or load metrics
+        of any session, when artifacts are likely to grow, or timeout
+        """
+        return self._tank_activity.wait(
+            timeout=datetime.timedelta(seconds=timeout))
 
-    def set_session_status(self, session_id, new_status):
-        """Remember session status and change running_id"""
+    def set_upload_progress(self, session_id, filename, progress):
+        """Remember progress dict of an upload"""
+        self._uploads.setdefault(session_id, {})[filename] = progress
 
-        if new_status['status'] in ['success', 'failed']:
-            if self._running_id == session_id:
-                self._running_id = None
-        else:
-            self._running_id = session_id
+    def drop_upload_progress(self, session_id, filename, progress):
+        """Forget progress of an upload, unless a newer one replaced it"""
+        files = self._uploads.get(session_id, {})
+        if files.get(filename) is progress:
+            del files[filename]
+            if not files:
+                del self._uploads[session_id]
 
-        self._sessions[session_id] = new_status
+    def upload_progress(self, session_id, filename):
+        """Get upload progress, can raise KeyError"""
+        return self._uploads[session_id][filename]
 
     def heartbeat(self, session_id, new_timeout=None):
         """
-        Set new heartbeat timeout (if sepcified)
-        and reset heartbeat deadline
+        Set new heartbeat timeout of the running session (if sepcified)
+        and reset its heartbeat deadline.
+        The session is stopped if the deadline passes.
         """
+        if session_id not in self._running_ids:
+            return
         if new_timeout is not None:
-            self._hb_timeout = new_timeout
-        if session_id == self._running_id and self._running_id is not None:
-            self._hb_deadline = time.time() + self._hb_timeout
+            self._hb_timeouts[session_id] = new_timeout
+        ioloop = tornado.ioloop.IOLoop.current()
+        deadline = ioloop.time() + self._hb_timeouts.get(
+            session_id, DEFAULT_HEARTBEAT_TIMEOUT)
+        self._hb_deadlines[session_id] = deadline
+        # The timer is moved to a later deadline when it fires,
+        # so it should be rescheduled only if the deadline became earlier
+        timer = self._hb_timers.get(session_id)
+        if timer is not None:
+            if timer[0] <= deadline:
+                return
+            ioloop.remove_timeout(timer[1])
+        self._hb_timers[session_id] = (
+            deadline,
+            ioloop.call_at(deadline, self._check_heartbeat, session_id))
+
+    def _check_heartbeat(self, session_id):
+        """Stop the session if its heartbeat deadline has passed"""
+        del self._hb_timers[session_id]
+        ioloop = tornado.ioloop.IOLoop.current()
+        deadline = self._hb_deadlines[session_id]
+        if deadline > ioloop.time():
+            self._hb_timers[session_id] = (
+                deadline,
+                ioloop.call_at(deadline, self._check_heartbeat, session_id))
+            return
+        self.cmd({
+            'cmd': 'run',
+            'session': session_id,
+            'break': 'finished'
+        })
+        self.cmd({'cmd': 'stop', 'session': session_id})
+
+    def _stop_heartbeat(self, session_id):
+        """Forget heartbeat of the finished session"""
+        timer = self._hb_timers.pop(session_id, None)
+        if timer is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(timer[1])
+        self._hb_timeouts.pop(session_id, None)
+        self._hb_deadlines.pop(session_id, None)
 
     def session_dir(self, session_id):
         """Return working directory for given session id"""
@@ -436,32 +1934,156 @@ class ApiServer(object):
         os.makedirs(session_dir)
         return session_id
 
+    def is_finished_session(self, session_id):
+        """Return true if the session has reached final status"""
+        try:
+            return self.status(session_id)['status'] in sessions.FINAL_STATUSES
+        except KeyError:
+            return False
+
+    @tornado.gen.coroutine
+    def artifact_manifest(self, session_id):
+        """
+        Return future of list of artifact entries and frozen flag.
+        Manifests of finished sessions are cached
+        and rebuilt only when the session directory mtime changes.
+        """
+        basepath = self.session_dir(session_id)
+        # Taken before the scan, files added later change the mtime
+        try:
+            status = yield self.load_status(session_id)
+            frozen = status['status'] in sessions.FINAL_STATUSES
+        except KeyError:
+            frozen = False
+        dir_mtime = yield self.run_in_io_pool(os.path.getmtime, basepath)
+        cached = self._manifests.get(session_id)
+        if cached is not None and cached['frozen'] \
+                and cached['dir_mtime'] == dir_mtime:
+            raise tornado.gen.Return((cached['files'], True))
+        files = yield self.run_in_io_pool(
+            scan_artifacts, basepath,
+            cached['files'] if cached is not None else None)
+        self._manifests.put(
+            session_id, {
+                'files': files,
+                'dir_mtime': dir_mtime,
+                'frozen': frozen
+            })
+        raise tornado.gen.Return((files, frozen))
+
     def is_empty_session(self, session_id):
         """Return true if the session did not get past the lock stage"""
         return not os.path.exists(self.session_file(session_id, 'status.json'))
 
+    def run_in_io_pool(self, func, *args):
+        """Run blocking file operation in the IO thread pool, return future"""
+        return tornado.ioloop.IOLoop.current().run_in_executor(
+            self._io_pool, func, *args)
+
     def cmd(self, message):
         """Put commad into manager queue"""
         self._out_queue.put(message)
 
-    @property
-    def all_sessions(self):
-        """Get session status by ID, can raise KeyError"""
-        return self._sessions
+    def find_sessions(self, **kwargs):
+        """
+        Return list of (session_id, status) pairs and total count,
+        see SessionRegistry.find for filter arguments
+        """
+        return self._registry.find(**kwargs)
 
     def status(self, session_id):
-        """Get session status by ID, can raise KeyError"""
-        return self._sessions[session_id]
+        """
+        Get status of an active or recently finished session by ID,
+        can raise KeyError. Older sessions are looked up by load_status.
+        """
+        if session_id in self._queued:
+            status = dict(self._sessions[session_id])
+            status['position'], status['estimated_start'] = \
+                self._queue_estimates()[session_id]
+            return status
+        try:
+            return self._sessions[session_id]
+        except KeyError:
+            pass
+        finished = self._finished.get(session_id)
+        if finished is None:
+            raise KeyError(session_id)
+        return finished[0]
 
-    @property
-    def running_id(self):
-        """Return ID of running session"""
-        return self._running_id
+    @tornado.gen.coroutine
+    def load_status(self, session_id):
+        """
+        Return future of session status by ID, which can raise KeyError.
+        Sessions missing in memory are looked up in the registry
+        in the IO pool.
+        """
+        try:
+            raise tornado.gen.Return(self.status(session_id))
+        except KeyError:
+            pass
+        status = yield self.run_in_io_pool(self._registry.get, session_id)
+        try:
+            # Session could change while the registry was read
+            raise tornado.gen.Return(self.status(session_id))
+        except KeyError:
+            pass
+        self._finished.put(session_id, (status, 0))
+        raise tornado.gen.Return(status)
+
+    def status_version(self, session_id):
+        """Get status version of a session known to status()"""
+        if session_id in self._versions:
+            return self._versions[session_id]
+        finished = self._finished.get(session_id)
+        return finished[1] if finished is not None else 0
 
     @property
-    def running_status(self):
-        """Return status of running session , can raise KeyError"""
-        return self.status(self._running_id)
+    def running_ids(self):
+        """Return IDs of running sessions, in order of start"""
+        return list(self._running_ids)
+
+    def is_running(self, session_id):
+        """Return true if the session is running"""
+        return session_id in self._running_ids
+
+    def metric_gauges(self):
+        """Return gauges for metrics, see Metrics.render"""
+
+        def queue_size(queue):
+            try:
+                return queue.qsize()
+            except NotImplementedError:
+                # Not available on macOS
+                return None
+
+        return [
+            ('tank_api_running_sessions', 'Running sessions',
+             [([], len(self._running_ids))]),
+            ('tank_api_busy_session_slots',
+             'Running sessions that have not released the lock',
+             [([], self.busy_slots())]),
+            ('tank_api_max_sessions', 'Maximum number of running sessions',
+             [([], self.max_sessions)]),
+            ('tank_api_queued_sessions', 'Sessions waiting in the queue',
+             [([], self.queue_length())]),
+            ('tank_api_ipc_queue_depth', 'Messages waiting in IPC queues',
+             [([('queue', 'webserver')], queue_size(self._in_queue)),
+              ([('queue', 'manager')], queue_size(self._out_queue))]),
+            ('tank_api_uploads', 'Uploads in progress or recently finished',
+             [([], sum(len(files) for files in self._uploads.values()))]),
+            ('tank_api_cache_entries', 'Entries in internal caches',
+             [([('cache', 'manifest')], len(self._manifests)),
+              ([('cache', 'validation')], len(self.validation_cache))]),
+        ]
+
+    def is_load_running(self):
+        """Return true if any running session has not reached postprocess yet"""
+        for session_id in self._running_ids:
+            cur_stage = self._sessions[session_id].get('current_stage')
+            if cur_stage is not None \
+                    and common.is_a_earlier_than_b(cur_stage, 'postprocess'):
+                return True
+        return False
 
     def serve(self):
         """
@@ -469,10 +2091,17 @@ class ApiServer(object):
         """
         server = tornado.httpserver.HTTPServer(self.app)
         server.listen(8888)
+        tornado.ioloop.IOLoop.current().add_callback(
+            self.run_in_io_pool, self._registry.sync)
+        tornado.ioloop.PeriodicCallback(
+            self.read_status_updates, STATUS_DRAIN_INTERVAL * 1000).start()
         tornado.ioloop.IOLoop.current().start()
 
 
-def main(webserver_queue, manager_queue, test_directory, debug):
+def main(
+        webserver_queue, manager_queue, test_directory, debug,
+        upload_size_limit=None, max_sessions=1, session_queue_limit=None,
+        configs_location='/etc'):
     """Target for webserver process.
     The only function ever used by the Manager.
 
@@ -485,5 +2114,20 @@ def main(webserver_queue, manager_queue, test_directory, debug):
     test_directory
         Directory where tests are
 
+    upload_size_limit
+        Maximum size of uploaded file in bytes
+
+    max_sessions
+        Maximum number of concurrently running sessions
+
+    session_queue_limit
+        Maximum number of queued sessions
+
+    configs_location
+        Configs are validated against yandex-tank configs found here
+
     """
-    ApiServer(webserver_queue, manager_queue, test_directory, debug).serve()
+    ApiServer(
+        webserver_queue, manager_queue, test_directory, debug,
+        upload_size_limit, max_sessions, session_queue_limit,
+        configs_location).serve()
@@ -4,14 +4,18 @@ Based on ConsoleWorker from yandex-tank
 """
 
 import signal
+import copy
 import fnmatch
+import glob
+import functools
+import importlib
 import logging
 import os
 import os.path
 import traceback
 import json
+import psutil
 import yaml
-import itertools as itt
 import time
 
 import yandextank.core as tankcore
@@ -22,10 +26,107 @@ import threading
 
 # Test stage order, internal protocol description, etc...
 import yandex_tank_api.common as common
+import yandex_tank_api.latency as latency
 
 
 _log = logging.getLogger(__name__)
 
+# libyaml loader is much faster, but may be unavailable
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+DEFAULT_STATUS_MAX_RATE = 5.0
+# Lock directory is checked for changes this often while waiting for lock
+LOCK_POLL_INTERVAL = 0.1
+# Lock is retried at least this often, to notice holders that died
+LOCK_RECHECK_INTERVAL = 1.0
+# Wall clock is rechecked this often while waiting for scheduled start
+START_AT_RECHECK_INTERVAL = 1.0
+PHOUT_WILDCARD = 'phout*.log'
+
+# Plugin methods timed separately and stages they are called at
+TIMED_PLUGIN_METHODS = [
+    ('configure', 'configure'),
+    ('prepare_test', 'prepare'),
+    ('start_test', 'start'),
+    ('end_test', 'end'),
+    ('post_process', 'postprocess'),
+]
+
+
+def get_configs_from_dir(config_dir):
+    """
+    Returns configs from specified directory, sorted alphabetically
+    """
+    configs = []
+    try:
+        conf_names = os.listdir(config_dir)
+        conf_names.sort()
+        for filename in conf_names:
+            if fnmatch.fnmatch(filename, '*.yaml'):
+                config_path = os.path.realpath(
+                    config_dir + os.sep + filename)
+                _log.debug("Adding config file: %s", config_path)
+                with open(config_path) as config_file:
+                    try:
+                        configs.append(
+                            yaml.load(config_file, Loader=SafeLoader))
+                    except yaml.YAMLError:
+                        _log.error('Failed to unyaml a config at {}'.format(config_path))
+
+    except OSError:
+        _log.warning(
+            "Failed to get configs from %s", config_dir, exc_info=True)
+
+    return configs
+
+
+def config_dir_signature(config_dir):
+    """Return value that changes when configs in the directory change"""
+    signature = []
+    try:
+        for filename in sorted(os.listdir(config_dir)):
+            if fnmatch.fnmatch(filename, '*.yaml'):
+                stat = os.stat(os.path.join(config_dir, filename))
+                signature.append((filename, stat.st_mtime, stat.st_size))
+    except OSError:
+        return None
+    return tuple(signature)
+
+
+class MachineDefaults(object):
+    """
+    Machine default configs parsed once by manager and given to workers,
+    webserver validates configs against them.
+    Configs are parsed again only when the files change.
+    """
+
+    def __init__(self, configs_location):
+        self.config_dir = '{}/yandex-tank/'.format(configs_location)
+        self._core_base_cfg = None
+        self._configs = None
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return list of machine default configs"""
+        return self.get_with_signature()[0]
+
+    def get_with_signature(self):
+        """
+        Return list of machine default configs
+        and the signature of their files
+        """
+        with self._lock:
+            if self._core_base_cfg is None:
+                self._core_base_cfg = core_console.load_core_base_cfg()
+            signature = config_dir_signature(self.config_dir)
+            if self._configs is None or signature != self._signature:
+                _log.info(
+                    'Loading machine defaults from %s', self.config_dir)
+                self._configs = get_configs_from_dir(self.config_dir)
+                self._signature = signature
+            return [self._core_base_cfg] + self._configs, self._signature
+
 
 class InterruptTest(BaseException):
     """Raised by sigterm handler"""
@@ -53,7 +154,180 @@ class TankCore(tankcore.TankCore):
 
     def publish(self, publisher, key, value):
         super(TankCore, self).publish(publisher, key, value)
-        self.tank_worker.report_status('running', False)
+        self.tank_worker.status_publisher.mark_dirty()
+
+
+def live_metrics_point(data, stats):
+    """
+    Return compact per-second load metrics
+    made of tank aggregator data and stats items.
+    Times are in microseconds, as in the aggregator.
+    """
+    overall = data['overall']
+    interval = overall['interval_real']
+    count = interval['len']
+    point = {
+        'ts': data['ts'],
+        'rps': count,
+        'planned_rps': stats.get('metrics', {}).get('reqps'),
+        'instances': stats.get('metrics', {}).get('instances'),
+        'mean': float(interval['total']) / count if count else None,
+        'max': interval.get('max'),
+        'quantiles': {},
+        'hist': interval.get('hist', {'bins': [], 'data': []}),
+        'proto_code': overall['proto_code']['count'],
+        'net_code': overall['net_code']['count'],
+    }
+    if 'q' in interval:
+        point['quantiles'] = dict(
+            (str(int(q)), value)
+            for q, value in zip(interval['q']['q'], interval['q']['value']))
+    return point
+
+
+def lock_dir_signature(lock_dir):
+    """Return value that changes when lock files are added or removed"""
+    try:
+        return os.stat(lock_dir).st_mtime
+    except OSError:
+        return None
+
+
+def lock_holders(lock_dir):
+    """Return list of info dicts of the lock files in lock_dir"""
+    holders = []
+    pattern = os.path.join(
+        lock_dir, tankcore.tankcore.Lock.LOCK_FILE_WILDCARD)
+    for lock_file in sorted(glob.glob(pattern)):
+        try:
+            info = dict(tankcore.tankcore.Lock.load(lock_file).info)
+        except Exception:
+            info = {}
+        info['lock_file'] = lock_file
+        holders.append(info)
+    return holders
+
+
+def is_sibling_process(pid):
+    """Return true if pid is another tank process of this API server"""
+    try:
+        return psutil.Process(int(pid)).ppid() == os.getppid()
+    except (psutil.Error, TypeError, ValueError):
+        return False
+
+
+def foreign_lock_holders(lock_dir):
+    """
+    Return holders of the lock files in lock_dir
+    other than the tank processes of this API server.
+    Holders whose process has exited do not hold the lock.
+    """
+    foreign = []
+    for holder in lock_holders(lock_dir):
+        pid = holder.get(tankcore.tankcore.Lock.PID)
+        if pid is not None and (
+                is_sibling_process(pid) or not psutil.pid_exists(int(pid))):
+            continue
+        foreign.append(holder)
+    return foreign
+
+
+class LiveMetricsListener(object):
+    """
+    Aggregate result listener.
+    Sends per-second load metrics of the running test to manager.
+    """
+
+    def __init__(self, manager_queue, session_id):
+        self.manager_queue = manager_queue
+        self.session_id = session_id
+
+    def on_aggregated_data(self, data, stats):
+        try:
+            point = live_metrics_point(data, stats)
+        except (KeyError, TypeError):
+            _log.warning('Unexpected aggregated data', exc_info=True)
+            return
+        self.manager_queue.put({
+            'session': self.session_id,
+            'live_metrics': point
+        })
+
+    def monitoring_data(self, data):
+        """Monitoring data is not aggregated"""
+
+
+class StatusPublisher(object):
+    """
+    Sends worker status to manager and dumps status.json.
+    Reports requested via mark_dirty are coalesced
+    and sent at most max_rate times per second by a background thread,
+    reports requested via report are sent immediately.
+    Status is copied on the thread that requests the report,
+    the background thread and the queue feeder only see the copy.
+    Nothing is sent after the final status.
+    """
+
+    def __init__(self, manager_queue, make_status, max_rate):
+        self.manager_queue = manager_queue
+        self.make_status = make_status
+        self.min_interval = 1.0 / max_rate
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = None
+        self._finished = False
+        self._last_sent = 0
+        flusher = threading.Thread(target=self._flush_loop)
+        flusher.daemon = True
+        flusher.start()
+
+    def report(self, status, stage_completed):
+        """Send status now"""
+        with self._lock:
+            self._send(self._snapshot(status, stage_completed))
+
+    def mark_dirty(self):
+        """Request coalesced status report"""
+        if self._finished:
+            return
+        with self._lock:
+            self._pending = self._snapshot('running', False)
+        self._wakeup.set()
+
+    def _snapshot(self, status, stage_completed):
+        """Return copy of status message and whether to dump it"""
+        msg, dump = self.make_status(status, stage_completed)
+        return copy.deepcopy(msg), dump
+
+    def _send(self, snapshot):
+        """Should be called with lock held"""
+        msg, dump = snapshot
+        self._pending = None
+        self._finished = msg['status'] in ['success', 'failed']
+        self._last_sent = time.time()
+        msg['reported_at'] = self._last_sent
+        self.manager_queue.put(msg)
+        if dump:
+            with open('status.json.tmp', 'w') as f:
+                json.dump(msg, f, indent=4)
+            os.rename('status.json.tmp', 'status.json')
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # Immediate reports may move the next slot while we sleep
+            delay = self._last_sent + self.min_interval - time.time()
+            while delay > 0:
+                time.sleep(delay)
+                delay = self._last_sent + self.min_interval - time.time()
+            with self._lock:
+                if self._pending is None or self._finished:
+                    continue
+                try:
+                    self._send(self._pending)
+                except Exception:
+                    _log.exception('Failed to report status')
 
 
 class TankWorker(object):
@@ -61,7 +335,9 @@ class TankWorker(object):
 
     def __init__(
             self, tank_queue, manager_queue, working_dir, lock_dir, session_id,
-            ignore_machine_defaults, configs_location):
+            ignore_machine_defaults, configs_location,
+            status_max_rate=DEFAULT_STATUS_MAX_RATE, startup=None,
+            shared_lock=False, lock_wait_timeout=None, machine_defaults=None):
 
         # Parameters from manager
         self.tank_queue = tank_queue
@@ -70,6 +346,7 @@ class TankWorker(object):
         self.session_id = session_id
         self.ignore_machine_defaults = ignore_machine_defaults
         self.configs_location = configs_location
+        self.machine_defaults = machine_defaults
 
         # State variables
         self.break_at = 'lock'
@@ -79,6 +356,16 @@ class TankWorker(object):
         self.done_stages = set()
         self.lock_dir = lock_dir
         self.lock = None
+        self.shared_lock = shared_lock
+        self.lock_wait_timeout = lock_wait_timeout
+        self.lock_wait = {}
+        self.scheduled_start = {}
+        self.histograms_writer = None
+        self.startup = startup or {}
+        self.timings = {}
+        self.plugin_timings = {}
+        self.status_publisher = StatusPublisher(
+            manager_queue, self.make_status, status_max_rate)
 
         print(lock_dir)
 
@@ -115,72 +402,143 @@ class TankWorker(object):
         self.__add_log_file(logger, logging.DEBUG, os.path.join(self.core.artifacts_dir, 'tank.log'))
         self.__add_log_file(logger, logging.INFO, os.path.join(self.core.artifacts_dir, 'tank_brief.log'))
 
-    @staticmethod
-    def __get_configs_from_dir(config_dir):
-        """
-        Returns configs from specified directory, sorted alphabetically
-        """
-        configs = []
-        try:
-            conf_names = os.listdir(config_dir)
-            conf_names.sort()
-            for filename in conf_names:
-                if fnmatch.fnmatch(filename, '*.yaml'):
-                    config_path = os.path.realpath(
-                        config_dir + os.sep + filename)
-                    _log.debug("Adding config file: %s", config_path)
-                    with open(config_path) as config_file:
-                        try:
-                            configs.append(yaml.safe_load(config_file))
-                        except yaml.YAMLError:
-                            _log.error('Failed to unyaml a config at {}'.format(config_path))
-
-        except OSError:
-            _log.warning(
-                "Failed to get configs from %s", config_dir, exc_info=True)
-
-        return configs
-
     def __get_configs(self):
         """Returns list of all configs for this test"""
-        configs = list(
-            itt.chain(
-                [core_console.load_core_base_cfg()]
-                    if not self.ignore_machine_defaults else [],
-                self.__get_configs_from_dir('{}/yandex-tank/'.format(self.configs_location))
-                    if not self.ignore_machine_defaults else [],
-                self.__get_configs_from_dir('.'),
-                )
-        )
-        return configs
+        if self.ignore_machine_defaults:
+            machine_defaults = []
+        elif self.machine_defaults is not None:
+            # Parsed by manager
+            machine_defaults = self.machine_defaults
+        else:
+            machine_defaults = MachineDefaults(self.configs_location).get()
+        return machine_defaults + get_configs_from_dir('.')
 
     def __preconfigure(self):
         """Logging and TankCore setup"""
         self.__setup_logging()
         self.core.load_plugins()
+        self.__time_plugins()
+
+    def __time_plugins(self):
+        """Wrap plugin methods to measure how long each plugin takes"""
+        for plugin_name, plugin in self.core.plugins.items():
+            for method_name, stage in TIMED_PLUGIN_METHODS:
+                method = getattr(plugin, method_name, None)
+                if method is not None:
+                    setattr(
+                        plugin, method_name,
+                        self.__timed(method, stage, plugin_name))
+
+    def __timed(self, method, stage, plugin_name):
+        """Return method that records its duration into plugin_timings"""
+
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            started = common.monotonic()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.plugin_timings.setdefault(stage, {})[plugin_name] = \
+                    common.monotonic() - started
+
+        return timed
 
     def __get_lock(self):
-        """Get lock and remember that we succeded in getting lock"""
-        while not self.core.interrupted.is_set():
+        """
+        Get lock and remember that we succeded in getting lock.
+        While waiting, retry as soon as lock files change
+        and report lock holders in status.
+        """
+        ignore_lock = self.core.config.get_option(
+            self.core.SECTION, 'ignore_lock')
+        lock_dir = self.core.lock_dir
+        started = time.time()
+        while True:
+            if self.core.interrupted.is_set():
+                raise KeyboardInterrupt
+            signature = lock_dir_signature(lock_dir)
             try:
-                self.lock = tankcore.tankcore.Lock(self.core.test_id, self.core.lock_dir).acquire(self.core.lock_dir,
-                                                               self.core.config.get_option(self.core.SECTION, 'ignore_lock'))
+                ignore = ignore_lock
+                if self.shared_lock and not ignore_lock:
+                    # Sessions of the same API server share the lock,
+                    # locks of other tanks are respected
+                    if foreign_lock_holders(lock_dir):
+                        raise tankcore.tankcore.LockError(
+                            'Lock is held by another tank')
+                    ignore = True
+                self.lock = tankcore.tankcore.Lock(
+                    self.core.test_id, lock_dir).acquire(lock_dir, ignore)
                 break
             except tankcore.tankcore.LockError:
                 if not self.core.wait_lock:
                     raise RuntimeError("Lock file present, cannot continue")
-                _log.warning(
-                    "Couldn't get lock. Will retry in 5 seconds...")
-                time.sleep(5)
-        else:
-            raise KeyboardInterrupt
+            holders = lock_holders(lock_dir)
+            if holders != self.lock_wait.get('holders'):
+                _log.warning("Couldn't get lock, held by %s. Waiting...", holders)
+                self.lock_wait = {'started': started, 'holders': holders}
+                self.status_publisher.mark_dirty()
+            # Sleep until lock files change, but not too long
+            recheck_at = time.time() + LOCK_RECHECK_INTERVAL
+            if self.lock_wait_timeout is not None:
+                deadline = started + self.lock_wait_timeout
+                if time.time() >= deadline:
+                    self.lock_wait['waited'] = time.time() - started
+                    raise RuntimeError(
+                        'Failed to get lock in {} seconds, held by {}'.format(
+                            self.lock_wait_timeout, holders))
+                recheck_at = min(recheck_at, deadline)
+            while lock_dir_signature(lock_dir) == signature \
+                    and time.time() < recheck_at \
+                    and not self.core.interrupted.wait(LOCK_POLL_INTERVAL):
+                pass
+        if self.lock_wait:
+            self.lock_wait = {
+                'started': started,
+                'waited': time.time() - started,
+                'holders': []
+            }
+
+    def __configure(self):
+        self.core.plugins_configure()
+        self.core.job.subscribe_plugin(
+            LiveMetricsListener(self.manager_queue, self.session_id))
 
     def __end(self):
         return self.core.plugins_end_test(self.retcode)
 
     def __postprocess(self):
+        # Phouts are complete after the end stage.
+        # Histograms are made while plugins postprocess and are waited for
+        # after unlock, so they hold neither the lock nor the session slot
+        self.histograms_writer = threading.Thread(
+            target=self.__write_latency_histograms)
+        self.histograms_writer.start()
         return self.core.plugins_post_process(self.retcode)
 
+    def __find_phouts(self):
+        """Return phout files in the artifacts and session directories"""
+        found = {}
+        for directory in (self.core.artifacts_dir, '.'):
+            for filename in glob.glob(
+                    os.path.join(directory, PHOUT_WILDCARD)):
+                found.setdefault(os.path.realpath(filename), filename)
+        return sorted(found.values())
+
+    def __write_latency_histograms(self):
+        """Save per-second response time histograms made of phouts"""
+        phouts = self.__find_phouts()
+        if not phouts:
+            return
+        started = common.monotonic()
+        try:
+            latency.from_phouts(phouts).save(latency.ARTIFACT_NAME)
+        except Exception:
+            _log.warning('Failed to make latency histograms', exc_info=True)
+            return
+        _log.info(
+            'Latency histograms of %s made in %.1f s', phouts,
+            common.monotonic() - started)
+
     def __release_lock(self):
         if self.lock is not None:
             self.lock.release()
@@ -211,8 +569,29 @@ class TankWorker(object):
                 _log.info(
                     'Changing the next break from %s to %s', self.break_at, brk)
                 self.break_at = brk
+                if msg.get('start_at') is not None:
+                    self.__wait_until(msg['start_at'])
                 return
 
+    def __wait_until(self, start_at):
+        """
+        Sleep until the wall-clock time start_at before leaving the break,
+        record how late the test actually continued
+        """
+        self.scheduled_start = {'at': start_at}
+        self.report_status('running', True)
+        _log.info('Will continue the test at %s', start_at)
+        while True:
+            remaining = start_at - time.time()
+            if remaining <= 0:
+                break
+            # Sleep in short steps to follow wall clock adjustments
+            time.sleep(min(remaining, START_AT_RECHECK_INTERVAL))
+        skew = time.time() - start_at
+        self.scheduled_start['skew'] = skew
+        if skew > START_AT_RECHECK_INTERVAL:
+            _log.warning('Scheduled start is late by %.3f s', skew)
+
     def answer(self, plugin, attr):
         """
         answers for /ask handler
@@ -238,6 +617,10 @@ class TankWorker(object):
 
     def report_status(self, status, stage_completed):
         """Report status to manager and dump status.json, if required"""
+        self.status_publisher.report(status, stage_completed)
+
+    def make_status(self, status, stage_completed):
+        """Return status message and whether status.json should be dumped"""
         msg = {
             'status': 'prepared' if self.break_at == 'start' and self.stage == 'prepare' and stage_completed else status,
             'session': self.session_id,
@@ -247,11 +630,20 @@ class TankWorker(object):
             'failures': self.failures,
             'retcode': self.retcode,
             'tank_status': self.core.status,
+            'startup': self.startup,
+            'timings': self.timings,
+            'plugin_timings': self.plugin_timings,
+            'lock_wait': self.__lock_wait_status(),
+            'scheduled_start': dict(self.scheduled_start),
         }
-        self.manager_queue.put(msg)
-        if self.locked:
-            with open('status.json', 'w') as f:
-                json.dump(msg, f, indent=4)
+        return msg, self.locked
+
+    def __lock_wait_status(self):
+        """Return lock wait info with the time waited so far"""
+        lock_wait = dict(self.lock_wait)
+        if 'started' in lock_wait and 'waited' not in lock_wait:
+            lock_wait['waited'] = time.time() - lock_wait['started']
+        return lock_wait
 
     def process_failure(self, reason):
         """
@@ -267,7 +659,7 @@ class TankWorker(object):
         new_retcode = {
             'init': self.__preconfigure,
             'lock': self.__get_lock,
-            'configure': self.core.plugins_configure,
+            'configure': self.__configure,
             'prepare': self.core.plugins_prepare_test,
             'start': self.core.plugins_start_test,
             'poll': self.core.wait_for_finish,
@@ -293,6 +685,9 @@ class TankWorker(object):
         self.report_status('running', False)
         if stage == common.TEST_STAGE_ORDER[0] or common.TEST_STAGE_DEPS[
                 stage] in self.done_stages:
+            timing = {'started': time.time()}
+            self.timings[stage] = timing
+            started = common.monotonic()
             try:
                 self._execute_stage(stage)
             except InterruptTest as exc:
@@ -307,6 +702,11 @@ class TankWorker(object):
                 self.process_failure('Exception:' + traceback.format_exc())
             else:
                 self.done_stages.add(stage)
+            timing['duration'] = common.monotonic() - started
+            timing['finished'] = timing['started'] + timing['duration']
+            if stage == 'init' and 'requested_at' in self.startup:
+                self.startup['init_done'] = \
+                    time.time() - self.startup['requested_at']
         else:
             self.process_failure('skipped')
 
@@ -316,6 +716,8 @@ class TankWorker(object):
         """Perform the test sequence via TankCore"""
         for stage in common.TEST_STAGE_ORDER[:-1]:
             self.next_stage(stage)
+        if self.histograms_writer is not None:
+            self.histograms_writer.join()
         self.stage = 'finished'
         self.report_status('failed' if self.failures else 'success', True)
         _log.info('Done performing test with code %s', self.retcode)
@@ -330,7 +732,10 @@ def signal_handler(signum, _):
 
 def run(
         tank_queue, manager_queue, work_dir, lock_dir, session_id,
-        ignore_machine_defaults, configs_location):
+        ignore_machine_defaults, configs_location,
+        status_max_rate=DEFAULT_STATUS_MAX_RATE, requested_at=None,
+        warm=False, cpus=None, shared_lock=False, lock_wait_timeout=None,
+        machine_defaults=None):
     """
     Target for tank process.
     This is the only function from this module ever used by Manager.
@@ -341,10 +746,72 @@ def run(
     manager_queue
         Write tank status there
 
+    status_max_rate
+        Maximum number of status reports per second between stage changes
+
+    requested_at
+        Time when the session was requested, for startup timing
+
+    warm
+        True if the process was started in advance
+
+    cpus
+        CPUs the tank process should be pinned to
+
+    shared_lock
+        True if other sessions of this server may run concurrently
+
+    lock_wait_timeout
+        Seconds to wait for the lock held by another tank, None to wait forever
+
+    machine_defaults
+        Machine default configs parsed by manager, None to read them here
+
     """
+    if requested_at is None:
+        requested_at = time.time()
+    startup = {
+        'warm': warm,
+        'requested_at': requested_at,
+        'worker_ready': time.time() - requested_at,
+    }
+    if cpus:
+        os.sched_setaffinity(0, cpus)
     os.chdir(work_dir)
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     TankWorker(
         tank_queue, manager_queue, work_dir, lock_dir, session_id,
-        ignore_machine_defaults, configs_location).perform_test()
+        ignore_machine_defaults, configs_location,
+        status_max_rate, startup, shared_lock,
+        lock_wait_timeout, machine_defaults).perform_test()
+
+
+def preload_plugins(configs):
+    """Import plugin packages mentioned in configs"""
+    for config in configs:
+        for section in (config or {}).values():
+            if not isinstance(section, dict) or 'package' not in section:
+                continue
+            try:
+                importlib.import_module(section['package'])
+            except Exception:
+                _log.warning(
+                    'Failed to preload plugin %s', section['package'],
+                    exc_info=True)
+
+
+def run_spare(
+        tank_queue, manager_queue, ignore_machine_defaults, configs_location,
+        machine_defaults=None):
+    """
+    Target for spare tank process.
+    Imports plugins from machine defaults and waits for a session.
+    The first message in tank_queue should be {'assign': kwargs for run}.
+    """
+    if not ignore_machine_defaults:
+        preload_plugins(
+            machine_defaults if machine_defaults is not None else
+            MachineDefaults(configs_location).get())
+    msg = tank_queue.get()
+    run(tank_queue, manager_queue, warm=True, **msg['assign'])